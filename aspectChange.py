@@ -1,27 +1,475 @@
+import time
+_START = time.perf_counter()     # 起動時間の計測用（--startup-time）
+
 from PySide6.QtCore import *
 from PySide6.QtWidgets import *
 from PySide6.QtGui import *
 import sys
-from PIL import Image, ExifTags
 import os
+import struct
+import zlib
+import threading
+import json
+import hashlib
+import weakref
+import io
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+# argparse / multiprocessing / cProfile / tempfile / shutil は起動を遅くするので、使う所で読み込む
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+# 100MP を超えるパノラマも扱うので、Qt / Pillow の画像サイズ上限は外しておく
+# （メモリ使用量はメモリ予算の設定で抑える）
+QImageReader.setAllocationLimit(0)
+
+EXIF_IFD = 0x8769
+
+
+_pil_image = None
+
+def pil():
+    # Pillow は EXIF の読み書きやエンコードで初めて必要になった時に読み込む（起動を速くするため）
+    global _pil_image
+    if _pil_image is None:
+        from PIL import Image
+        Image.MAX_IMAGE_PIXELS = None
+        _pil_image = Image
+    return _pil_image
+
+
+_image_cms = None
+
+def pil_cms():
+    # ICC プロファイルを持った画像を開いた時に初めて読み込む
+    global _image_cms
+    if _image_cms is None:
+        from PIL import ImageCms
+        _image_cms = ImageCms
+    return _image_cms
+
+
+_numpy = None
+
+def np_module():
+    # NumPy も合成処理で初めて必要になった時に読み込む。入っていなければ None
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def load_preview(filepath, max_size):
+    # 書き出しなどですでにデコード済みなら、それを縮小するだけにする
+    # 画面は sRGB として表示するので、プレビューは出力の設定に関わらず sRGB に変換する
+    source = source_registry.peek(filepath)
+    if source is not None:
+        image = source.qimage()
+        if max(source.size.width(), source.size.height()) > max_size:
+            image = image.scaled(max_size, max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        return convert_to_srgb(image, source.icc_profile), source.size
+
+    # 画面サイズに縮小してデコードする（JPEG は libjpeg の DCT スケーリングで縮小デコードされる）
+    reader = QImageReader(filepath)
+    size = reader.size()
+    if not size.isValid():
+        raise ValueError(reader.errorString())
+
+    if max(size.width(), size.height()) > max_size:
+        reader.setScaledSize(size.scaled(max_size, max_size, Qt.KeepAspectRatio))
+
+    image = reader.read()
+    if image.isNull():
+        raise ValueError(reader.errorString())
+    return convert_to_srgb(image, read_metadata(filepath).icc_profile), size
+
+
+def load_preview_cached(filepath, max_size):
+    # ディスクキャッシュにあれば元画像をデコードせずに使う
+    cached = preview_disk_cache.get(filepath, max_size)
+    if cached is not None:
+        return cached
+    image, size = load_preview(filepath, max_size)
+    if max(size.width(), size.height()) > max_size:
+        # 縮小せずに読めた小さい画像は、元画像を読むのと変わらないので保存しない
+        preview_disk_cache.put(filepath, max_size, image, size)
+    return image, size
+
+
+class PreviewSignals(QObject):
+    loaded = Signal(str, QImage, QSize)
+    failed = Signal(str, str)
+
+
+class PreviewTask(QRunnable):
+    def __init__(self, filepath, max_size):
+        super().__init__()
+        self.filepath = filepath
+        self.max_size = max_size
+        self.signals = PreviewSignals()
+
+    def run(self):
+        try:
+            image, size = load_preview_cached(self.filepath, self.max_size)
+        except Exception as e:
+            self.signals.failed.emit(self.filepath, str(e))
+            return
+        self.signals.loaded.emit(self.filepath, image, size)
+
+
+class AutoCropSignals(QObject):
+    placed = Signal(str, object)     # ファイル, プレビュー座標の枠 (x, y, w, h)
+
+
+class AutoCropTask(QRunnable):
+    def __init__(self, filepath, image):
+        super().__init__()
+        self.filepath = filepath
+        self.image = image
+        self.signals = AutoCropSignals()
+
+    def run(self):
+        try:
+            crop = auto_crop(self.image, self.image.width(), self.image.height())
+        except Exception as e:
+            print(f"枠の自動配置に失敗しました: {e}")
+            return
+        self.signals.placed.emit(self.filepath, crop)
+
+
+# ---- メモリの管理（デコード済みの画像のバッファをアプリ全体で数え、上限を超えないようにする） ----
+# 元画像・プレビュー・表示用の pixmap・書き込み待ちのデータは種類ごとに数え、
+# 出力の合成に使う分は出力の開始時に見積もりで予約する
+# 上限を超えそうな時は、キャッシュを捨てる → プレビューを小さくする・先読みをやめる → 出力を1つずつにする の順で抑える
+
+class MemoryGovernor:
+    DEFAULT_MB = 4096
+    PRESSURE = 0.9      # 上限のこの割合を超えたら、プレビューを小さくして先読みをやめる
+
+    def __init__(self, budget_bytes):
+        self.budget = budget_bytes
+        self.cond = threading.Condition()
+        self.usage = {}             # 種類 -> バイト数
+        self.current = 0
+        self.peak = 0
+        self.reservations = 0       # 実行中の出力の数
+        self.reclaimers = []        # (名前, 弱参照のメソッド)。reclaim(bytes) で捨てられるだけ捨てる
+
+    def add(self, category, nbytes):
+        with self.cond:
+            self.usage[category] = self.usage.get(category, 0) + nbytes
+            self.current += nbytes
+            self.peak = max(self.peak, self.current)
+
+    def release(self, category, nbytes):
+        with self.cond:
+            self.usage[category] = self.usage.get(category, 0) - nbytes
+            self.current -= nbytes
+            self.cond.notify_all()
+
+    def track(self, obj, category, nbytes):
+        # obj が破棄された時に自動で数から外す
+        self.add(category, nbytes)
+        weakref.finalize(obj, self.release, category, nbytes)
+
+    def register_reclaimer(self, name, method):
+        self.reclaimers.append((name, weakref.WeakMethod(method)))
+
+    def make_room(self, nbytes):
+        # nbytes を新たに使う前に、上限を超える分だけキャッシュを捨てる
+        # （キャッシュ側のロックを取るので、自分のロックは持たずに呼ぶ）
+        for name, ref in list(self.reclaimers):
+            excess = self.current + nbytes - self.budget
+            if excess <= 0:
+                return
+            method = ref()
+            if method is not None:
+                method(excess)
+
+    def reserve(self, nbytes):
+        # 出力の合成に使う分を予約する。他の出力が動いていて収まらない時は、終わるまで待つ（出力を1つずつにする）
+        while True:
+            self.make_room(nbytes)
+            with self.cond:
+                if self.reservations == 0 or self.current + nbytes <= self.budget:
+                    self.reservations += 1
+                    self.usage["export"] = self.usage.get("export", 0) + nbytes
+                    self.current += nbytes
+                    self.peak = max(self.peak, self.current)
+                    return
+                self.cond.wait(0.5)
+
+    def unreserve(self, nbytes):
+        with self.cond:
+            self.reservations -= 1
+            self.usage["export"] -= nbytes
+            self.current -= nbytes
+            self.cond.notify_all()
+
+    @contextmanager
+    def reservation(self, nbytes):
+        self.reserve(nbytes)
+        try:
+            yield
+        finally:
+            self.unreserve(nbytes)
+
+    def under_pressure(self):
+        return self.current > self.budget * self.PRESSURE
+
+    def set_budget(self, budget_bytes):
+        self.budget = budget_bytes
+        self.make_room(0)
+        with self.cond:
+            self.cond.notify_all()
+
+    def reset_peak(self):
+        with self.cond:
+            self.peak = self.current
+
+    def snapshot(self):
+        with self.cond:
+            return {"current": self.current, "peak": self.peak, "budget": self.budget, "usage": {k: v for k, v in self.usage.items() if v}}
+
+
+memory_governor = MemoryGovernor(MemoryGovernor.DEFAULT_MB * 1024 * 1024)
+
+
+def format_memory(snapshot):
+    mb = 1024 * 1024
+    return f"メモリ {snapshot['current'] / mb:.0f}MB / 上限 {snapshot['budget'] / mb:.0f}MB (最大 {snapshot['peak'] / mb:.0f}MB)"
+
+
+class PreviewCache:
+    # 縮小デコード済みのプレビューを、合計バイト数の上限つきで保持する（LRU）
+    # メモリが足りない時は別のスレッドから reclaim で減らされるので、ロックを取って操作する
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # path -> (mtime, image, source_size)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        memory_governor.register_reclaimer("preview", self.reclaim)
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None:
+            return None
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if entry[0] != mtime:
+            # ファイルが書き換えられていたら使わない
+            self.remove(path)
+            return None
+        with self.lock:
+            if path in self.entries:
+                self.entries.move_to_end(path)
+        return entry[1], entry[2]
+
+    def put(self, path, image, source_size):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        self.remove(path)
+        memory_governor.make_room(image.sizeInBytes())
+        with self.lock:
+            self.entries[path] = (mtime, image, source_size)
+            self.total_bytes += image.sizeInBytes()
+            memory_governor.add("preview", image.sizeInBytes())
+            # 直近に入れたものは残す
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                self.pop_oldest()
+
+    def remove(self, path):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.total_bytes -= entry[1].sizeInBytes()
+                memory_governor.release("preview", entry[1].sizeInBytes())
+
+    def pop_oldest(self):
+        # lock を持った状態で呼ぶ
+        _, entry = self.entries.popitem(last=False)
+        self.total_bytes -= entry[1].sizeInBytes()
+        memory_governor.release("preview", entry[1].sizeInBytes())
+        return entry[1].sizeInBytes()
+
+    def reclaim(self, nbytes):
+        # 古いものから捨てる（表示中の最新の1枚は残す）
+        freed = 0
+        with self.lock:
+            while freed < nbytes and len(self.entries) > 1:
+                freed += self.pop_oldest()
+        return freed
+
+    def __contains__(self, path):
+        with self.lock:
+            return path in self.entries
+
+
+class DiskPreviewCache:
+    # 画面サイズのプレビューとサムネイルのディスクキャッシュ（次の日に同じ写真を開き直しても元画像をデコードしない）
+    # キーはパス・サイズ・更新日時と縮小サイズ。合計サイズが上限を超えたら、最後に使ったのが古いものから消す（LRU）
+    DEFAULT_MB = 512
+
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.total_bytes = None     # 初めて書き込む時に数える
+
+    def cache_dir(self):
+        if self.directory is None:
+            self.directory = os.path.join(app_cache_dir(), "previews")
+        os.makedirs(self.directory, exist_ok=True)
+        return self.directory
+
+    def file_for(self, path, max_size):
+        st = os.stat(path)
+        key = f"{os.path.abspath(path)}\0{st.st_size}\0{st.st_mtime_ns}\0{max_size}\0srgb"
+        return os.path.join(self.cache_dir(), hashlib.sha1(key.encode("utf-8", "surrogatepass")).hexdigest())
+
+    def get(self, path, max_size):
+        if self.max_bytes <= 0:
+            return None
+        try:
+            name = self.file_for(path, max_size)
+            if not os.path.exists(name):
+                return None
+            image = QImage(name)
+            w, h = (int(v) for v in image.text("sourceSize").split("x"))
+            os.utime(name)          # 使った順を更新日時で覚える
+        except (OSError, ValueError):
+            return None
+        if image.isNull():
+            return None
+        return image, QSize(w, h)
+
+    def put(self, path, max_size, image, source_size):
+        if self.max_bytes <= 0:
+            return
+        try:
+            name = self.file_for(path, max_size)
+        except OSError:
+            return
+        # 別のスレッドと同じファイルを書いても壊れないよう、一時ファイルに書いてから置き換える
+        tmp = f"{name}.{threading.get_ident()}.tmp"
+        image = QImage(image)
+        image.setText("sourceSize", f"{source_size.width()}x{source_size.height()}")
+        writer = QImageWriter(tmp, b"PNG" if image.hasAlphaChannel() else b"JPEG")
+        writer.setQuality(90)
+        if not writer.write(image):
+            print(f"プレビューをキャッシュに保存できませんでした: {writer.errorString()}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        try:
+            size = os.path.getsize(tmp)
+            os.replace(tmp, name)
+        except OSError:
+            return
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.scan())
+            else:
+                self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def scan(self):
+        entries = []
+        try:
+            for entry in os.scandir(self.cache_dir()):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, st.st_size, st.st_mtime))
+        except OSError:
+            pass
+        return entries
+
+    def evict(self):
+        # 上限の9割まで減らして、書き込むたびに消すのを避ける
+        entries = sorted(self.scan(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.total_bytes = total
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            if max_bytes <= 0:
+                self.clear()
+            elif self.total_bytes is not None and self.total_bytes > max_bytes:
+                self.evict()
+
+    def clear(self):
+        for path, _, _ in self.scan():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.total_bytes = 0
+
+
+preview_disk_cache = DiskPreviewCache(DiskPreviewCache.DEFAULT_MB * 1024 * 1024)
 
 
 class CropView(QGraphicsView):
-    # シグナルを定義 (読み込んだファイルのパスを渡す)
-    fileDropped = Signal(str)
+    # シグナルを定義 (ドロップされたファイル・フォルダのパスを渡す)
+    filesDropped = Signal(list)
+    imageLoaded = Signal(str)
+    loadFailed = Signal(str, str)
 
-    def __init__(self):
+    def __init__(self, cache_bytes=256 * 1024 * 1024):
         super().__init__()
         self.setAcceptDrops(True)
 
         self.scene = QGraphicsScene(self)
         self.setScene(self.scene)
 
-        self.pixmap_item = None
+        # 描画の設定
+        # シーンのアイテムは座標計算用で表示しない。画像は表示サイズに縮小済みの pixmap を drawBackground で貼り、
+        # 枠と枠の外の暗幕は drawForeground で描く。再描画する範囲は枠が動いた部分だけを自分で指定する
+        self.setViewportUpdateMode(QGraphicsView.NoViewportUpdate)
+        self.setCacheMode(QGraphicsView.CacheNone)
+        self.setOptimizationFlags(QGraphicsView.DontSavePainterState | QGraphicsView.DontAdjustForAntialiasing)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.preview_image = None
+        self.display_pixmap = None
+        self.display_rect = QRect()     # display_pixmap を貼る位置（ビューポート座標）
+        self.drawn_crop = QRect()       # 最後に描いた枠（ビューポート座標）
+
+        self.image_item = None
         self.dragging = None
         self.crop_rect = None
         self.last_pos = None
         self.current_file = None
+        self.source_size = None     # 元画像のサイズ（プレビューは縮小されている）
+        self.wanted_file = None     # 表示を待っているファイル
+        self.loading = set()        # デコード中のファイル
+        self.preview_cache = PreviewCache(cache_bytes)
+        self.auto_crop = True
+        self.auto_crops = {}        # ファイル -> 自動配置した枠（プレビュー座標）
+        self.crop_adjusted = False  # 表示後に枠を手で動かしたか
+        self.crop_restored = False  # サイドカーの枠を置いたか
 
     # ... (resizeEvent, load_image, mouse系イベントはそのまま) ...
 
@@ -36,61 +484,244 @@ class CropView(QGraphicsView):
 
     def dropEvent(self, event):
         urls = event.mimeData().urls()
-        if not urls:
+        paths = [url.toLocalFile() for url in urls if url.isLocalFile()]
+        if not paths:
             return
 
-        path = urls[0].toLocalFile()
-        if path.lower().endswith((".png", ".jpg", ".jpeg", ".bmp")):
-            # ここで直接 load_image せず、シグナルを送るか、
-            # load_imageした後にシグナルを送る
-            
-            # 今回はView側で表示更新しつつ、親に通知する形にします
-            self.load_image(path)
-            
-            # メインウィンドウに通知
-            self.fileDropped.emit(path)
+        # 読み込みはバックグラウンドで行うので、ここでは親に通知するだけにする
+        # （フォルダの展開や表示は親の open_files で行う）
+        self.filesDropped.emit(paths)
 
     def resizeEvent(self, event):
         super().resizeEvent(event)
 
-        if self.pixmap_item is None:
+        if self.image_item is None:
             return
 
         self.fitInView(
             self.sceneRect(),
             Qt.KeepAspectRatio
         )
+        self.rebuild_display()
+
+    def rebuild_display(self):
+        # 表示用の pixmap をビューポートの解像度で作り直す（サイズが変わった時だけ）
+        self.display_rect = self.mapFromScene(self.sceneRect()).boundingRect()
+        dpr = self.devicePixelRatioF()
+        size = self.display_rect.size() * dpr
+        if self.display_pixmap is None or self.display_pixmap.size() != size:
+            scaled = self.preview_image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            pixmap = QPixmap.fromImage(scaled)
+            pixmap.setDevicePixelRatio(dpr)
+            self.set_display_pixmap(pixmap)
+        self.drawn_crop = self.crop_view_rect()
+        self.viewport().update()
+
+    def set_display_pixmap(self, pixmap):
+        # 表示用の pixmap もメモリの使用量に数える
+        if self.display_pixmap is not None:
+            memory_governor.release("display", 4 * self.display_pixmap.width() * self.display_pixmap.height())
+        self.display_pixmap = pixmap
+        if pixmap is not None:
+            memory_governor.add("display", 4 * pixmap.width() * pixmap.height())
+
+    def crop_view_rect(self):
+        if self.crop_rect is None:
+            return QRect()
+        return self.mapFromScene(self.crop_rect.sceneBoundingRect()).boundingRect()
+
+    def update_crop(self):
+        # 枠が動いた時は、前後の枠の差の部分（暗幕が変わる所）と枠線の周りだけを描き直す
+        new = self.crop_view_rect()
+        old = self.drawn_crop
+        if new == old:
+            return
+        margin = self.CROP_PEN_WIDTH + 2
+        region = QRegion(old).xored(QRegion(new))
+        for rect in (old, new):
+            outer = rect.adjusted(-margin, -margin, margin, margin)
+            region += QRegion(outer).subtracted(QRegion(rect.adjusted(margin, margin, -margin, -margin)))
+        self.drawn_crop = new
+        self.viewport().update(region)
+
+    CROP_PEN_WIDTH = 3
+    MASK_COLOR = QColor(0, 0, 0, 110)
+
+    def drawBackground(self, painter, rect):
+        super().drawBackground(painter, rect)
+        if self.display_pixmap is None:
+            return
+        painter.save()
+        painter.resetTransform()
+        painter.drawPixmap(self.display_rect.topLeft(), self.display_pixmap)
+        painter.restore()
+
+    def drawForeground(self, painter, rect):
+        if self.display_pixmap is None or self.crop_rect is None:
+            return
+        painter.save()
+        painter.resetTransform()
+        image = self.display_rect
+        crop = self.crop_view_rect()
+        # 枠の外を暗くする（4本の帯を塗るだけ）
+        painter.fillRect(QRect(image.left(), image.top(), image.width(), crop.top() - image.top()), self.MASK_COLOR)
+        painter.fillRect(QRect(image.left(), crop.bottom() + 1, image.width(), image.bottom() - crop.bottom()), self.MASK_COLOR)
+        painter.fillRect(QRect(image.left(), crop.top(), crop.left() - image.left(), crop.height()), self.MASK_COLOR)
+        painter.fillRect(QRect(crop.right() + 1, crop.top(), image.right() - crop.right(), crop.height()), self.MASK_COLOR)
+        pen = QPen(QColor(0, 255, 0), self.CROP_PEN_WIDTH)
+        pen.setCosmetic(True)
+        pen.setJoinStyle(Qt.MiterJoin)
+        painter.setPen(pen)
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(crop)
+        painter.restore()
+
+    def preview_max_size(self):
+        screen = self.screen()
+        size = screen.size() * screen.devicePixelRatio()
+        return max(size.width(), size.height())
 
     def load_image(self, filename):
-        pixmap = QPixmap(filename)
+        # プレビューキャッシュにあればすぐ表示、無ければバックグラウンドでデコードする
+        self.wanted_file = filename
+        entry = self.preview_cache.get(filename)
+        if entry is not None:
+            self.show_preview(filename, *entry)
+            return
+        self.request_preview(filename)
+
+    def prefetch(self, filenames):
+        # 前後の画像を先読みしてキャッシュに入れておく（メモリが足りない時はしない）
+        if memory_governor.under_pressure():
+            return
+        for filename in filenames:
+            if filename not in self.preview_cache:
+                self.request_preview(filename)
+
+    def request_preview(self, filename):
+        if filename in self.loading:
+            return
+        self.loading.add(filename)
+        max_size = self.preview_max_size()
+        if memory_governor.under_pressure():
+            # メモリが足りない時は小さめのプレビューで我慢する
+            max_size //= 2
+        task = PreviewTask(filename, max_size)
+        task.signals.loaded.connect(self.on_preview_loaded)
+        task.signals.failed.connect(self.on_preview_failed)
+        QThreadPool.globalInstance().start(task)
+
+    def on_preview_loaded(self, filename, image, source_size):
+        self.loading.discard(filename)
+        self.preview_cache.put(filename, image, source_size)
+        # 先読みした画像も、表示される前に枠の位置を決めておく
+        if self.auto_crop:
+            self.request_auto_crop(filename, image)
+        # 先読みや、すでに別の画像に移った後の結果は表示しない
+        if filename == self.wanted_file:
+            self.show_preview(filename, image, source_size)
+
+    def show_preview(self, filename, image, source_size):
         self.current_file = filename
+        self.source_size = source_size
         self.scene.clear()
         
-        self.pixmap_item = QGraphicsPixmapItem(pixmap)
-        self.scene.addItem(self.pixmap_item)
+        # 画像の範囲を表すだけのアイテム（表示は drawBackground で行う）
+        self.preview_image = image
+        self.set_display_pixmap(None)
+        self.image_item = QGraphicsRectItem(0, 0, image.width(), image.height())
+        self.image_item.setPen(Qt.NoPen)
+        self.image_item.setVisible(False)
+        self.scene.addItem(self.image_item)
         
-        self.setSceneRect(self.pixmap_item.boundingRect())
+        self.setSceneRect(self.image_item.boundingRect())
         self.fitInView(self.sceneRect(), Qt.KeepAspectRatio)
 
-        img_rect = self.pixmap_item.boundingRect()
-
-        # 枠サイズは短辺固定の4:5
-        crop_w = img_rect.width()
-        crop_h = crop_w * 5 / 4
-        if crop_h > img_rect.height():
-            crop_h = img_rect.height()
-            crop_w = crop_h * 4 / 5
+        img_rect = self.image_item.boundingRect()
+        crop_x, crop_y, crop_w, crop_h = default_crop(img_rect.width(), img_rect.height())
+        self.crop_adjusted = False
+        self.crop_restored = False
+        if self.auto_crop:
+            # 自動配置の結果がまだなければ、いったん左上に置いて結果を待つ
+            crop_x, crop_y, crop_w, crop_h = self.auto_crops.get(filename, (crop_x, crop_y, crop_w, crop_h))
+            self.request_auto_crop(filename, image)
 
+        # 枠も座標計算用のアイテムで、表示は drawForeground で行う
         self.crop_rect = QGraphicsRectItem(0, 0, crop_w, crop_h)
-        self.crop_rect.setPen(QPen(QColor(0, 255, 0), 5))  # 薄紫
-        self.crop_rect.setBrush(Qt.NoBrush)
+        self.crop_rect.setPos(crop_x, crop_y)
+        self.crop_rect.setPen(Qt.NoPen)
+        self.crop_rect.setVisible(False)
         self.scene.addItem(self.crop_rect)
+        self.rebuild_display()
+
+        self.imageLoaded.emit(filename)
+
+    def request_auto_crop(self, filename, image):
+        if filename in self.auto_crops:
+            return
+        task = AutoCropTask(filename, image)
+        task.signals.placed.connect(self.on_auto_crop)
+        QThreadPool.globalInstance().start(task)
+
+    def on_auto_crop(self, filename, crop):
+        self.auto_crops[filename] = crop
+        # 表示中の画像で、まだ手で動かしていなければ枠を移す
+        if filename != self.current_file or self.crop_rect is None or self.crop_adjusted or self.crop_restored:
+            return
+        x, y, w, h = crop
+        if self.crop_rect.rect().size() == QSizeF(w, h):
+            self.crop_rect.setPos(x, y)
+            self.update_crop()
+
+    def on_preview_failed(self, filename, detail):
+        self.loading.discard(filename)
+        if filename == self.wanted_file:
+            self.loadFailed.emit(filename, detail)
+
+    def crop_geometry(self):
+        # プレビュー座標の枠を元画像のピクセル座標に変換する（書き出し時のみ使用）
+        rect = self.crop_rect.rect()
+        pos = self.crop_rect.pos()
+        img_rect = self.image_item.boundingRect()
+        full_w = self.source_size.width()
+        full_h = self.source_size.height()
+        sx = full_w / img_rect.width()
+        sy = full_h / img_rect.height()
+
+        # 縮小時の丸めで縦横の倍率がわずかに違うので、大きい方を使って比率を保つ
+        scale = max(sx, sy)
+        w = rect.width() * scale
+        h = rect.height() * scale
+        fit = min(1, full_w / w, full_h / h)
+        w *= fit
+        h *= fit
+        x = max(0, min(pos.x() * sx, full_w - w))
+        y = max(0, min(pos.y() * sy, full_h - h))
+        return x, y, w, h
+
+    def set_crop_geometry(self, crop):
+        # 元画像のピクセル座標の枠（サイドカーに保存したもの）をプレビュー座標に戻して置く
+        if self.crop_rect is None:
+            return
+        img_rect = self.image_item.boundingRect()
+        sx = self.source_size.width() / img_rect.width()
+        sy = self.source_size.height() / img_rect.height()
+        scale = max(sx, sy)
+        x, y, w, h = crop
+        w = min(w / scale, img_rect.width())
+        h = min(h / scale, img_rect.height())
+        self.crop_rect.setRect(0, 0, w, h)
+        self.crop_rect.setPos(max(0, min(x / sx, img_rect.width() - w)), max(0, min(y / sy, img_rect.height() - h)))
+        # 自動配置の結果で上書きしないようにする
+        self.crop_restored = True
+        self.update_crop()
 
 
     def mousePressEvent(self, event):
         if self.crop_rect is None:
             return
         self.dragging = True
+        self.crop_adjusted = True
         self.last_pos = self.mapToScene(event.position().toPoint())
 
     def mouseMoveEvent(self, event):
@@ -102,7 +733,7 @@ class CropView(QGraphicsView):
 
         rect = self.crop_rect.rect()
         pos0 = self.crop_rect.pos()
-        img_rect = self.pixmap_item.boundingRect()
+        img_rect = self.image_item.boundingRect()
 
         new_x = pos0.x() + delta.x()
         new_y = pos0.y() + delta.y()
@@ -114,6 +745,7 @@ class CropView(QGraphicsView):
 
         self.crop_rect.setPos(new_x, new_y)
         self.last_pos = pos
+        self.update_crop()
 
 
     def mouseReleaseEvent(self, event):
@@ -121,7 +753,7 @@ class CropView(QGraphicsView):
 
 
     def wheelEvent(self, event):
-        if self.crop_rect is None or self.pixmap_item is None:
+        if self.crop_rect is None or self.image_item is None:
             return
 
         delta = event.angleDelta().y()
@@ -129,6 +761,7 @@ class CropView(QGraphicsView):
             return
 
         scale_step = 20 if delta > 0 else -20  # 拡大・縮小量（調整可）
+        self.crop_adjusted = True
 
         self.resize_crop_rect(scale_step)
 
@@ -136,7 +769,7 @@ class CropView(QGraphicsView):
 
     def resize_crop_rect(self, delta):
         rect = self.crop_rect.rect()
-        img_rect = self.pixmap_item.boundingRect()
+        img_rect = self.image_item.boundingRect()
 
         # 現在の中心
         center = self.crop_rect.mapToScene(rect.center())
@@ -168,12 +801,13 @@ class CropView(QGraphicsView):
 
         # はみ出し防止
         self.clamp_crop_rect()
+        self.update_crop()
 
 
     def clamp_crop_rect(self):
         rect = self.crop_rect.rect()
         pos = self.crop_rect.pos()
-        img_rect = self.pixmap_item.boundingRect()
+        img_rect = self.image_item.boundingRect()
 
         x = pos.x()
         y = pos.y()
@@ -191,29 +825,362 @@ class CropView(QGraphicsView):
 
 
 
+class Filmstrip(QListWidget):
+    # セッション中の画像のサムネイル一覧（サムネイルはバックグラウンドで読み込む）
+    THUMB_SIZE = 96
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(False)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True)
+        self.setHorizontalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setIconSize(QSize(self.THUMB_SIZE, self.THUMB_SIZE))
+        self.setFixedHeight(self.THUMB_SIZE + 50)
+
+        # 表示用のデコードを邪魔しないよう、サムネイル用のスレッドは少なめにする
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+        self.rows = {}
+
+    def set_files(self, paths):
+        self.pool.clear()
+        self.clear()
+        self.rows = {}
+        for row, path in enumerate(paths):
+            item = QListWidgetItem(os.path.basename(path))
+            item.setToolTip(path)
+            self.addItem(item)
+            self.rows[path] = row
+
+            task = PreviewTask(path, self.THUMB_SIZE)
+            task.signals.loaded.connect(self.on_thumbnail_loaded)
+            self.pool.start(task)
+
+    def on_thumbnail_loaded(self, path, image, source_size):
+        row = self.rows.get(path)
+        if row is None:
+            return
+        self.item(row).setIcon(QIcon(QPixmap.fromImage(image)))
+
+
+def font_directories():
+    dirs = list(QStandardPaths.standardLocations(QStandardPaths.FontsLocation))
+    if sys.platform == "win32":
+        # ユーザー単位でインストールされたフォントは FontsLocation に含まれない
+        local = os.environ.get("LOCALAPPDATA")
+        if local:
+            dirs.append(os.path.join(local, "Microsoft", "Windows", "Fonts"))
+    elif sys.platform != "darwin":
+        dirs += ["/usr/share/fonts", "/usr/local/share/fonts", os.path.expanduser("~/.fonts")]
+    return sorted(set(os.path.normpath(d) for d in dirs if os.path.isdir(d)))
+
+
+def font_signature():
+    # フォントファイルの名前・サイズ・更新日時から作る指紋。インストール済みフォントが変わった時だけ値が変わる
+    crc = 0
+    count = 0
+    stack = font_directories()
+    while stack:
+        path = stack.pop()
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.name)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            crc = zlib.crc32(f"{entry.path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8", "surrogatepass"), crc)
+            count += 1
+    return f"{count}:{crc:08x}"
+
+
+class FontCatalog:
+    # フォントファミリー一覧のキャッシュ
+    # QFontDatabase.families() は全フォントを列挙するので遅い。一覧は app_data_dir に保存し、
+    # フォントの追加・削除でシグネチャが変わった時だけ作り直す
+    FILE_NAME = "font_catalog.json"
+
+    def __init__(self):
+        self._families = None
+        self._signature = None
+
+    def path(self):
+        return os.path.join(app_data_dir(), self.FILE_NAME)
+
+    def families(self):
+        signature = font_signature()
+        if self._families is not None and signature == self._signature:
+            return self._families
+        families = None
+        try:
+            with open(self.path(), encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("signature") == signature:
+                families = data.get("families")
+        except (OSError, ValueError):
+            pass
+        if not families:
+            families = list(QFontDatabase.families())
+            try:
+                with open(self.path(), "w", encoding="utf-8") as f:
+                    json.dump({"signature": signature, "families": families}, f, ensure_ascii=False)
+            except OSError as e:
+                print(f"フォント一覧を保存できませんでした: {e}")
+        self._families = families
+        self._signature = signature
+        return families
+
+
+font_catalog = FontCatalog()
+
+
+def sample_text(template, comment = ""):
+    # フォントのプレビュー用に、今日の日付でテンプレートを展開する
+    today = QDate.currentDate()
+    mapping = {
+        r"%year%": f"{today.year():04d}",
+        r"%month%": f"{today.month():02d}",
+        r"%day%": f"{today.day():02d}",
+        r"%comment%": comment or "コメント"
+    }
+    text = template
+    for k, v in mapping.items():
+        text = text.replace(k, v)
+    return " ".join(text.split()) or "AaBbあア亜"
+
+
+class FontListModel(QAbstractListModel):
+    FamilyRole = Qt.UserRole + 1
+
+    def __init__(self, families, parent = None):
+        super().__init__(parent)
+        self.families = list(families)
+        self.rows = {family: i for i, family in enumerate(self.families)}
+
+    def rowCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.families)
+
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        family = self.families[index.row()]
+        if role in (Qt.DisplayRole, self.FamilyRole):
+            return family
+        return None
+
+    def set_families(self, families):
+        self.beginResetModel()
+        self.families = list(families)
+        self.rows = {family: i for i, family in enumerate(self.families)}
+        self.endResetModel()
+
+    def family_changed(self, family):
+        row = self.rows.get(family)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+
+class FontFilterModel(QSortFilterProxyModel):
+    # 部分一致で絞り込み、前方一致するものを先に並べる
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.query = ""
+        self.setFilterCaseSensitivity(Qt.CaseInsensitive)
+
+    def set_query(self, text):
+        self.query = text.strip().casefold()
+        self.setFilterFixedString(self.query)
+        self.invalidate()
+        self.sort(0 if self.query else -1)
+
+    def lessThan(self, left, right):
+        a = self.sourceModel().data(left).casefold()
+        b = self.sourceModel().data(right).casefold()
+        pa = not a.startswith(self.query)
+        pb = not b.startswith(self.query)
+        if pa != pb:
+            return pa < pb
+        return left.row() < right.row()
+
+
+class FontPreviewSignals(QObject):
+    rendered = Signal(object, QImage)
+
+
+class FontPreviewTask(QRunnable):
+    def __init__(self, key, width, height):
+        super().__init__()
+        self.key = key
+        self.width = width
+        self.height = height
+        self.signals = FontPreviewSignals()
+
+    def run(self):
+        family, italic, text = self.key
+        image = QImage(self.width, self.height, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        font = QFont(family)
+        font.setItalic(italic)
+        font.setPixelSize(int(self.height * 0.7))
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.TextAntialiasing)
+        painter.setFont(font)
+        painter.setPen(Qt.black)
+        painter.drawText(image.rect(), Qt.AlignLeft | Qt.AlignVCenter, text)
+        painter.end()
+        self.signals.rendered.emit(self.key, image)
+
+
+class FontPreviewDelegate(QStyledItemDelegate):
+    # プレビューは表示される行の分だけ、描画する時に別スレッドで作る
+    PREVIEW_HEIGHT = 28
+    PREVIEW_WIDTH = 420
+    MAX_CACHE = 512
+
+    def __init__(self, model, parent = None):
+        super().__init__(parent)
+        self.model = model
+        self.text = ""
+        self.italic = False
+        self.cache = OrderedDict()
+        self.pending = set()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+
+    def set_sample(self, text, italic):
+        if (text, italic) == (self.text, self.italic):
+            return
+        self.text = text
+        self.italic = italic
+        # 待ち行列から捨てたタスクは描かれないので、待ちの記録も消して次に表示された時に頼み直す
+        self.pool.clear()
+        self.pending = set()
+
+    def key_for(self, family):
+        return (family, self.italic, self.text)
+
+    def sizeHint(self, option, index):
+        name_height = option.fontMetrics.height()
+        return QSize(self.PREVIEW_WIDTH, name_height + self.PREVIEW_HEIGHT + 8)
+
+    def paint(self, painter, option, index):
+        self.initStyleOption(option, index)
+        family = index.data(FontListModel.FamilyRole)
+        option.text = ""
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawControl(QStyle.CE_ItemViewItem, option, painter, option.widget)
+
+        rect = option.rect.adjusted(6, 2, -6, -2)
+        painter.save()
+        highlighted = option.state & QStyle.State_Selected
+        painter.setPen(option.palette.color(QPalette.HighlightedText if highlighted else QPalette.Text))
+        painter.drawText(rect, Qt.AlignLeft | Qt.AlignTop, family)
+        preview = self.cache.get(self.key_for(family))
+        if preview is not None:
+            self.cache.move_to_end(self.key_for(family))
+            top = rect.top() + option.fontMetrics.height() + 2
+            painter.drawImage(QPoint(rect.left(), top), preview)
+        else:
+            self.request(family)
+        painter.restore()
+
+    def request(self, family):
+        key = self.key_for(family)
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        task = FontPreviewTask(key, self.PREVIEW_WIDTH, self.PREVIEW_HEIGHT)
+        task.signals.rendered.connect(self.on_rendered)
+        self.pool.start(task)
+
+    def on_rendered(self, key, image):
+        self.pending.discard(key)
+        if key[1:] != (self.italic, self.text):
+            return
+        self.cache[key] = image
+        while len(self.cache) > self.MAX_CACHE:
+            self.cache.popitem(last=False)
+        self.model.family_changed(key[0])
+
+
 class FontFamilyDialog(QDialog):
-    def __init__(self, italic, parent = None):
+    def __init__(self, italic, sample = "", parent = None):
         super().__init__(parent)
         self.setWindowTitle("フォント選択")
+        self.resize(480, 560)
 
-        self.list = QListWidget()
-        for family in QFontDatabase.families():
-            self.list.addItem(family)
+        self.search = QLineEdit()
+        self.search.setPlaceholderText("フォント名で検索")
+        self.search.setClearButtonEnabled(True)
+
+        self.model = FontListModel(font_catalog.families(), self)
+        self.proxy = FontFilterModel(self)
+        self.proxy.setSourceModel(self.model)
+        self.delegate = FontPreviewDelegate(self.model, self)
+
+        # 行の高さを揃えて、見えている行だけを描画させる
+        self.list = QListView()
+        self.list.setModel(self.proxy)
+        self.list.setItemDelegate(self.delegate)
+        self.list.setUniformItemSizes(True)
+        self.list.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.list.doubleClicked.connect(self.accept)
 
         self.italic = QCheckBox("斜体（イタリック）")
         self.italic.setChecked(italic)
+        self.italic.toggled.connect(self.update_sample)
+        self.sample = sample
 
         ok = QPushButton("OK")
         ok.clicked.connect(self.accept)
 
+        self.search.textChanged.connect(self.proxy.set_query)
+        self.search.returnPressed.connect(self.select_first)
+
         layout = QVBoxLayout(self)
+        layout.addWidget(self.search)
         layout.addWidget(self.list)
         layout.addWidget(self.italic)
         layout.addWidget(ok)
+        self.update_sample()
+
+    def prepare(self, italic, sample, family = None):
+        # ダイアログを使い回す時に、最新のフォント一覧・テンプレート・選択状態に合わせる
+        families = font_catalog.families()
+        if families != self.model.families:
+            self.model.set_families(families)
+        self.sample = sample
+        self.italic.setChecked(italic)
+        self.update_sample()
+        self.search.clear()
+        row = self.model.rows.get(family)
+        if row is not None:
+            index = self.proxy.mapFromSource(self.model.index(row))
+            self.list.setCurrentIndex(index)
+            self.list.scrollTo(index, QAbstractItemView.PositionAtCenter)
+        self.search.setFocus()
+
+    def update_sample(self):
+        self.delegate.set_sample(self.sample, self.italic.isChecked())
+        self.list.viewport().update()
+
+    def select_first(self):
+        if self.proxy.rowCount() > 0:
+            self.list.setCurrentIndex(self.proxy.index(0, 0))
+            self.list.setFocus()
 
     def selected_family(self):
-        item = self.list.currentItem()
-        return item.text() if item else None
+        index = self.list.currentIndex()
+        return index.data(FontListModel.FamilyRole) if index.isValid() else None
 
     def selected_italic(self):
         item = self.italic.isChecked()
@@ -249,163 +1216,2568 @@ class TextTemplateDialog(QDialog):
 
 
 
-class ExportWorker(QObject):
-    finished = Signal(str)
-    error = Signal(str)
+# ---- 出力処理の段階ごとの計測 ----
 
-    def __init__(self, pixmap, crop_rect, text, family, save_path, comment, filepath, backgroundColor, fontColor, fontItalic):
-        super().__init__()
-        self.pixmap = pixmap
-        self.crop_rect = crop_rect
-        self.text = text
-        self.font_family = family
-        self.save_path = save_path
-        self.comment = comment
-        self.filepath = filepath
-        self.backgroundColor = backgroundColor
-        self.fontColor = fontColor
-        self.fontItalic = fontItalic
+class StageTimer:
+    # 段階ごとの所要時間を記録する。段階が入れ子になった場合は内側の時間を外側から除く
+    def __init__(self):
+        self.stages = OrderedDict()     # name -> 秒
+        self.stack = []                 # (name, 開始時刻)
+        self.counts = OrderedDict()     # name -> 回数（キャッシュのヒットなど）
+        self.start = time.perf_counter()
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            parent, t0 = self.stack[-1]
+            self.add(parent, now - t0)
+        self.stack.append((name, now))
+
+    def exit(self):
+        now = time.perf_counter()
+        name, t0 = self.stack.pop()
+        self.add(name, now - t0)
+        if self.stack:
+            self.stack[-1] = (self.stack[-1][0], now)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    @contextmanager
+    def active(self):
+        # このスレッドで実行される timed_stage をこのタイマーに記録する
+        previous = getattr(_timing, "timer", None)
+        _timing.timer = self
+        try:
+            yield self
+        finally:
+            _timing.timer = previous
 
-    def run(self):
+    def result(self):
+        result = {
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 2),
+            "stages_ms": {name: round(sec * 1000, 2) for name, sec in self.stages.items()},
+        }
+        if self.counts:
+            result["counts"] = dict(self.counts)
+        return result
+
+
+_timing = threading.local()
+
+
+@contextmanager
+def timed_stage(name):
+    timer = getattr(_timing, "timer", None)
+    if timer is None:
+        yield
+        return
+    timer.enter(name)
+    try:
+        yield
+    finally:
+        timer.exit()
+
+
+def count_event(name):
+    timer = getattr(_timing, "timer", None)
+    if timer is not None:
+        timer.count(name)
+
+
+def format_timings(result):
+    stages = " / ".join(f"{name} {ms:.0f}ms" for name, ms in result["stages_ms"].items())
+    return f"合計 {result['total_ms']:.0f}ms ({stages})"
+
+
+def app_cache_dir():
+    path = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation), "aspectChange")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def app_data_dir():
+    path = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericDataLocation), "aspectChange")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+_timing_log_lock = threading.Lock()
+
+def append_timing_log(record):
+    # 計測結果を JSON Lines で追記する
+    try:
+        line = json.dumps(record, ensure_ascii=False)
+        with _timing_log_lock:
+            with open(os.path.join(app_data_dir(), "export_timings.jsonl"), "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        print("計測ログの書き込み失敗:", e)
+
+
+def timing_record(filepath, save_path, result):
+    return dict({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "source": filepath, "output": save_path}, **result)
+
+
+def load_full_image(filepath):
+    with timed_stage("decode"):
+        image = QImage(filepath)
+    if image.isNull():
+        raise ValueError("画像を読み込めませんでした")
+    return image
+
+
+def default_crop(w, h):
+    # 枠サイズは短辺固定の4:5、位置は左上
+    crop_w = w
+    crop_h = crop_w * 5 / 4
+    if crop_h > h:
+        crop_h = h
+        crop_w = crop_h * 4 / 5
+    return 0, 0, crop_w, crop_h
+
+
+AUTO_CROP_THUMB = 256       # 枠の自動配置に使う縮小画像の長辺
+
+
+def crop_energy(rgb):
+    # 輪郭の強さと、平均色からの離れ具合（目立つ色）を足したエネルギー
+    np = np_module()
+    gray = rgb @ np.array([0.299, 0.587, 0.114], np.float32)
+    edge = np.zeros_like(gray)
+    edge[:, 1:] += np.abs(np.diff(gray, axis=1))
+    edge[1:, :] += np.abs(np.diff(gray, axis=0))
+    saliency = np.abs(rgb - rgb.mean(axis=(0, 1))).sum(axis=2)
+    return edge / (edge.mean() + 1e-6) + 0.5 * saliency / (saliency.mean() + 1e-6)
+
+
+def auto_crop(image: QImage, w, h):
+    # 4:5 の枠を、エネルギーが最も多く入る位置に置く（w, h は枠を置く画像のサイズ。image はその縮小画像でよい）
+    # 枠は短辺いっぱいなので、長辺方向の1次元の和を窓で滑らせるだけで済む
+    x, y, crop_w, crop_h = default_crop(w, h)
+    np = np_module()
+    slide_x = w - crop_w > 0.5
+    slide_y = h - crop_h > 0.5
+    if np is None or image.isNull() or not (slide_x or slide_y):
+        return x, y, crop_w, crop_h
+
+    with timed_stage("auto_crop"):
+        scale = min(1, AUTO_CROP_THUMB / max(image.width(), image.height()))
+        if scale < 1:
+            image = image.scaled(max(1, round(image.width() * scale)), max(1, round(image.height() * scale)), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        thumb = image.convertToFormat(QImage.Format_RGB32)
+        rgb = array_view(thumb)[..., 2::-1].astype(np.float32)
+        energy = crop_energy(rgb)
+
+        profile = energy.sum(axis=0 if slide_x else 1)
+        length = len(profile)
+        window = max(1, min(length, round(length * (crop_w / w if slide_x else crop_h / h))))
+        if length == window:
+            return x, y, crop_w, crop_h
+        sums = np.concatenate(([0], np.cumsum(profile)))
+        scores = sums[window:] - sums[:-window]
+        # 差がない時は中央寄りを選ぶ
+        positions = np.arange(len(scores))
+        scores = scores / (scores.max() + 1e-6) - 0.05 * np.abs(positions / (len(scores) - 1) - 0.5)
+        offset = int(np.argmax(scores)) / (len(scores) - 1)
+
+    if slide_x:
+        x = offset * (w - crop_w)
+    else:
+        y = offset * (h - crop_h)
+    return x, y, crop_w, crop_h
+
+
+def suggest_crop(filepath, w, h, auto=True):
+    # 書き出し用（元画像の座標）。自動配置しない時は従来どおり左上
+    if not auto:
+        return default_crop(w, h)
+    reader = QImageReader(filepath)
+    scale = min(1, AUTO_CROP_THUMB / max(w, h))
+    reader.setScaledSize(QSize(max(1, round(w * scale)), max(1, round(h * scale))))
+    return auto_crop(reader.read(), w, h)
+
+
+class ImageMetadata:
+    def __init__(self, exif_bytes, date_original, icc_profile=None):
+        self.exif_bytes = exif_bytes          # 元画像の EXIF（無ければ None）
+        self.date_original = date_original    # "YYYY:MM:DD HH:MM:SS"（無ければ None）
+        self.icc_profile = icc_profile        # 埋め込みの ICC プロファイル（無ければ None）
+
+
+class MetadataCache:
+    # ファイルごとに EXIF をヘッダーだけ読んで1回だけ解析し、パス+更新日時+サイズをキーに保持する
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta is not None:
+                self.entries.move_to_end(key)
+                return meta
+
+        meta = self.parse(path)
+
+        with self.lock:
+            self.entries[key] = meta
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return meta
+
+    def parse(self, path):
+        # Image.open はヘッダーのみ読み込み、画素はデコードしない
+        # ただし PNG の getexif() は、IDAT より後ろの eXIf を探すために画素をすべてデコードしてしまうので、
+        # ヘッダーに EXIF が無い PNG はチャンクを自分で探す
+        with pil().open(path) as img:
+            icc_profile = img.info.get("icc_profile") or None
+            if img.format == "PNG" and "exif" not in img.info:
+                exif = pil().Exif()
+                data = png_exif_chunk(path)
+                if data:
+                    exif.load(data)
+            else:
+                exif = img.getexif()
+            if not exif:
+                return ImageMetadata(None, None, icc_profile)
+
+            date_original = exif.get_ifd(EXIF_IFD).get(0x9003) or exif.get(0x9003)    # DateTimeOriginal
+            return ImageMetadata(exif.tobytes(), date_original, icc_profile)
+
+
+def png_exif_chunk(path):
+    # PNG のチャンクを順に見て eXIf の中身を返す（IDAT は読み飛ばすだけで展開しない）
+    with open(path, "rb") as f:
+        f.seek(8)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            length, tag = struct.unpack(">I4s", header)
+            if tag == b"eXIf":
+                return f.read(length)
+            if tag == b"IEND":
+                return None
+            f.seek(length + 4, os.SEEK_CUR)     # データと CRC
+
+
+metadata_cache = MetadataCache()
+
+
+def read_metadata(filepath):
+    try:
+        return metadata_cache.get(filepath)
+    except Exception as e:
+        print("EXIF 読み込み失敗:", e)
+        return ImageMetadata(None, None)
+
+
+# ---- カラーマネジメント（埋め込みの ICC プロファイルを sRGB に変換する） ----
+# 出力の色の扱い: "srgb" は画素を sRGB に変換して出力、"keep" は画素を変えずに元のプロファイルを出力に埋め込む
+COLOR_MODES = {
+    "srgb": "sRGB に変換する",
+    "keep": "元のプロファイルを埋め込む",
+}
+DEFAULT_COLOR_MODE = "srgb"
+
+
+class ColorTransformCache:
+    # LittleCMS の変換は作るのに時間がかかるので、(元のプロファイル, 変換先, モード, インテント) ごとに1回だけ作り、スレッド間で共有する
+    # NOCACHE で作った変換は、複数のスレッドから同時に使っても安全
+    # プロファイルのバイト列は MetadataCache が同じオブジェクトを返すので、そのままキーにする（ハッシュは1回だけ計算される）
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = {}      # バイト列 -> (ImageCmsProfile, 変換が必要か)
+        self.transforms = {}    # キー -> ImageCmsTransform
+
+    def profile(self, icc):
+        with self.lock:
+            info = self.profiles.get(icc)
+            if info is None:
+                info = self.profiles[icc] = self.parse(icc)
+            return info
+
+    @staticmethod
+    def parse(icc):
+        ImageCms = pil_cms()
         try:
-            rect = self.crop_rect.rect()
-            pos = self.crop_rect.pos()
-            crop_x = int(pos.x())
-            crop_y = int(pos.y())
-            crop_w = int(rect.width())
-            crop_h = int(rect.height())
+            profile = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+        except (ImageCms.PyCMSError, OSError) as e:
+            print("ICC プロファイル読み込み失敗:", e)
+            return None, False
+        # RGB 以外（CMYK・グレー）は Qt が読み込む時に RGB にしているので変換しない。sRGB なら変換は要らない
+        if profile.profile.xcolor_space != "RGB ":
+            return profile, False
+        return profile, not ImageCms.getProfileDescription(profile).strip().startswith("sRGB")
+
+    def is_rgb(self, icc):
+        profile, _ = self.profile(icc)
+        return profile is not None and profile.profile.xcolor_space == "RGB "
+
+    def transform(self, icc, mode, target="sRGB", intent=None):
+        # 変換が要らなければ None
+        profile, needed = self.profile(icc)
+        if not needed:
+            return None
+        ImageCms = pil_cms()
+        if intent is None:
+            intent = ImageCms.Intent.PERCEPTUAL
+        key = (icc, target, mode, intent)
+        with self.lock:
+            transform = self.transforms.get(key)
+            if transform is None:
+                with timed_stage("color_build"):
+                    transform = ImageCms.buildTransform(profile, ImageCms.createProfile(target), mode, mode, intent, ImageCms.Flags.NOCACHE)
+                self.transforms[key] = transform
+            return transform
+
+
+color_transforms = ColorTransformCache()
+
+
+def convert_to_srgb(image: QImage, icc_profile, in_place=False):
+    # 埋め込みプロファイルの画素を sRGB に変換した画像を返す（変換が要らなければそのまま返す）
+    # in_place なら、形式が合っている時は image 自体を書き換える（他と共有していない画像だけに使う）
+    if not icc_profile or image.isNull():
+        return image
+    alpha = image.hasAlphaChannel()
+    mode = "RGBA" if alpha else "RGBX"
+    transform = color_transforms.transform(icc_profile, mode)
+    if transform is None:
+        return image
+    with timed_stage("color"):
+        # Pillow から Qt のバッファをそのまま書き換える（共有されている QImage は bits() の時点で複製される）
+        fmt = QImage.Format_RGBA8888 if alpha else QImage.Format_RGBX8888
+        if not in_place or image.format() != fmt:
+            image = image.convertToFormat(fmt)
+        view = pil().frombuffer(mode, (image.width(), image.height()), image.bits(), "raw", mode, image.bytesPerLine(), 1)
+        transform.apply_in_place(view)
+    return image
+
+
+def output_icc_profile(filepath, options):
+    # "keep" の時だけ、元のプロファイルを出力に埋め込む（sRGB に変換した出力には埋め込まない）
+    if options.get("colorMode", DEFAULT_COLOR_MODE) != "keep":
+        return None
+    icc_profile = read_metadata(filepath).icc_profile
+    if icc_profile and color_transforms.is_rgb(icc_profile):
+        return icc_profile
+    return None
+
+
+class SourceImage:
+    # 1枚の写真について、デコード済みの画素（1つのバッファ）と、その色空間の ICC プロファイルを持つ
+    # 画素は Pillow がコピーせずに参照できる並び（RGBX8888 / RGBA8888）にしておき、
+    # Qt (QImage) と NumPy (array_view) は同じメモリを見る。ICC の変換も Pillow がこのバッファをその場で書き換える
+    def __init__(self, path, key, image, icc_profile=None):
+        self.path = path
+        self.key = key
+        self.image = image
+        self.icc_profile = icc_profile      # 画素の色空間（sRGB に変換したものは None）
+        self.size = image.size()
+        memory_governor.track(self, "source", self.nbytes)
+
+    @classmethod
+    def decode(cls, path, key, color_mode=DEFAULT_COLOR_MODE):
+        size = QImageReader(path).size()
+        if size.isValid():
+            memory_governor.make_room(4 * size.width() * size.height())
+        image = load_full_image(path)
+        # 同じ画素サイズの形式への変換はその場で行われ、バッファは増えない
+        with timed_stage("decode"):
+            if image.hasAlphaChannel():
+                image.convertTo(QImage.Format_RGBA8888)
+            else:
+                image.convertTo(QImage.Format_RGBX8888)
+        icc_profile = read_metadata(path).icc_profile
+        if color_mode == "srgb":
+            # 形式は変換済みなので、その場で sRGB に変換される
+            image = convert_to_srgb(image, icc_profile, in_place=True)
+            icc_profile = None
+        return cls(path, key, image, icc_profile)
+
+    @property
+    def nbytes(self):
+        return self.image.sizeInBytes()
+
+    def qimage(self):
+        return self.image
+
+
+class SourceRegistry:
+    # ファイルごとの SourceImage を共有する。同じファイルを同時に書き出しても、デコードは1回だけ
+    # 使い終わったものも max_bytes までは残しておき（LRU）、枠を変えての出力し直しなどで使い回す
+    # 色の扱い（sRGB に変換するか）ごとに別のものとして持つ
+    DEFAULT_MB = 512
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.live = weakref.WeakValueDictionary()   # key -> 使用中の SourceImage
+        self.recent = OrderedDict()                 # key -> 残しておく SourceImage
+        self.recent_bytes = 0
+        self.decoding = {}                          # key -> デコード中を待つための Lock
+
+    @staticmethod
+    def key(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+    def peek(self, path, color_mode=None):
+        # デコード済みなら返す（デコードはしない）。color_mode が None ならどちらの色の扱いでもよい
+        try:
+            key = self.key(path)
+        except OSError:
+            return None
+        with self.lock:
+            for mode in (COLOR_MODES if color_mode is None else (color_mode,)):
+                source = self.live.get(key + (mode,))
+                if source is not None:
+                    return source
+            return None
+
+    def acquire(self, path, color_mode=DEFAULT_COLOR_MODE):
+        key = self.key(path) + (color_mode,)
+        while True:
+            with self.lock:
+                source = self.live.get(key)
+                if source is not None:
+                    self.touch(source)
+                    return source
+                wait = self.decoding.get(key)
+                if wait is None:
+                    wait = self.decoding[key] = threading.Lock()
+                    wait.acquire()
+                    break
+            # 別のスレッドがデコード中なら終わるのを待って、結果を使う
+            with wait:
+                pass
+
+        try:
+            source = SourceImage.decode(path, key, color_mode)
+            with self.lock:
+                self.live[key] = source
+                self.touch(source)
+            return source
+        finally:
+            with self.lock:
+                del self.decoding[key]
+            wait.release()
+
+    def touch(self, source):
+        # lock を持った状態で呼ぶ
+        if source.key in self.recent:
+            self.recent.move_to_end(source.key)
+            return
+        if source.nbytes > self.max_bytes:
+            return
+        self.recent[source.key] = source
+        self.recent_bytes += source.nbytes
+        while self.recent_bytes > self.max_bytes:
+            _, old = self.recent.popitem(last=False)
+            self.recent_bytes -= old.nbytes
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.recent and self.recent_bytes > self.max_bytes:
+                _, old = self.recent.popitem(last=False)
+                self.recent_bytes -= old.nbytes
+
+    def reclaim(self, nbytes):
+        # 使い終わって残しているだけのものを古い順に手放す（使用中のものは出力が終われば解放される）
+        freed = 0
+        with self.lock:
+            while self.recent and freed < nbytes:
+                _, old = self.recent.popitem(last=False)
+                self.recent_bytes -= old.nbytes
+                freed += old.nbytes
+        return freed
+
+
+source_registry = SourceRegistry(SourceRegistry.DEFAULT_MB * 1024 * 1024)
+memory_governor.register_reclaimer("source", source_registry.reclaim)
+
+
+def open_source(filepath, color_mode=DEFAULT_COLOR_MODE):
+    return source_registry.acquire(filepath, color_mode)
+
+
+def expand_template(template, filepath, comment):
+    # 日付取得
+    text = template
+    with timed_stage("exif"):
+        value = read_metadata(filepath).date_original
+    # YYYY:MM:DD HH:MM:SS → MM月DD日
+    date_parts = value.split()[0].split(":") if isinstance(value, str) and value.split() else []
+    if value and len(date_parts) < 3:
+        # 日付の形式が違う時は、置き換えずにそのまま出力する
+        print("EXIF 読み込み失敗: 撮影日の形式が違います:", repr(value))
+    elif value:
+        mapping = {
+            r"%year%": date_parts[0],
+            r"%month%": date_parts[1],
+            r"%day%": date_parts[2],
+            r"%comment%": comment
+        }
+
+        for k, v in mapping.items():
+            text = text.replace(k, v)
+
+    #前後の空白を削除
+    return text.strip()
+
+
+def crop_layout(crop, scale=1):
+    # scale: 縮小デコードした画像の倍率。枠の太さは元の解像度で決めてから縮小する（どちらの経路でも見た目を揃える）
+    crop_x, crop_y, crop_w, crop_h = (int(v) for v in crop)
+    border = max(50, round(crop_w / scale) // 8)
+    if scale != 1:
+        border = max(1, round(border * scale))
+    return crop_x, crop_y, crop_w, crop_h, border
+
+
+def paint_frame(painter, crop_w, crop_h, border, text, family, backgroundColor, fontColor, fontItalic, scale=1):
+    # 枠
+    with timed_stage("border"):
+        pen = QPen(backgroundColor, border)
+        pen.setJoinStyle(Qt.MiterJoin)
+        pen.setCapStyle(Qt.SquareCap)
+        painter.setPen(pen)
+        painter.drawRect(border//2, border//2, crop_w + border - 1, crop_h + border - 1)
+
+    # 左下に文字描画
+    if text:
+        with timed_stage("text"):
+            paint_text(painter, crop_h, border, text, family, fontColor, fontItalic, scale)
+
+
+def paint_text(painter, crop_h, border, text, family, fontColor, fontItalic, scale=1):
+    # 文字の大きさと余白は元の解像度で決めてから scale 倍する（crop_layout と同じ）
+    font_size = max(18, round(crop_h / scale) //30)
+    font = QFont(family, font_size)
+    if scale != 1:
+        font_size *= scale
+        font.setPointSizeF(font_size)
+    font.setItalic(fontItalic)
+    painter.setFont(font)
+    painter.setPen(QPen(fontColor))
+
+    # 余白計算
+    left_margin = 100 * scale
+    top_margin = font_size * 2.5       # 上に2行分余白（見た目調整用）
+
+    # 描画 y座標 = キャンバス高さ - 下余白
+    y_pos = border + crop_h + top_margin
+    painter.drawText(left_margin, y_pos, text)
+
+
+def render_overlay(crop_w, crop_h, border, text, family, backgroundColor, fontColor, fontItalic, scale=1):
+    # 枠と文字だけを透明なキャンバスに描いたレイヤー（写真の部分は透明のまま）
+    canvas = QImage(crop_w + border*2, crop_h + border*2, QImage.Format_ARGB32_Premultiplied)
+    canvas.fill(Qt.transparent)
+    painter = QPainter(canvas)
+    painter.setRenderHint(QPainter.Antialiasing)
+    paint_frame(painter, crop_w, crop_h, border, text, family, backgroundColor, fontColor, fontItalic, scale)
+    painter.end()
+    return canvas
+
+
+class OverlayCache:
+    # 枠と文字のレイヤーを、大きさ・色・フォント・文字列が同じ出力で使い回す（LRU）
+    # 同じ日に撮った写真を続けて出力すると、枠の大きさも日付も同じになることが多い
+    # 写真はレイヤーの下に DestinationOver で敷くので、毎回枠と文字を描いた場合と画素単位で同じ結果になる
+    DEFAULT_MB = 256
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> QImage
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        memory_governor.register_reclaimer("overlay", self.reclaim)
+
+    def get(self, crop_w, crop_h, border, text, family, backgroundColor, fontColor, fontItalic, scale=1):
+        # 返す QImage は共有しているので書き換えない（描く時は QImage(overlay) で別に持つ）
+        key = (crop_w, crop_h, border, text, family, QColor(backgroundColor).rgba(), QColor(fontColor).rgba(), bool(fontItalic), scale)
+        with self.lock:
+            overlay = self.entries.get(key)
+            if overlay is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                count_event("overlay_hit")
+                return overlay
+            self.misses += 1
+        count_event("overlay_miss")
+
+        overlay = render_overlay(crop_w, crop_h, border, text, family, backgroundColor, fontColor, fontItalic, scale)
+        nbytes = overlay.sizeInBytes()
+        if nbytes > self.max_bytes:
+            return overlay
+        memory_governor.make_room(nbytes)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = overlay
+                self.total_bytes += nbytes
+                memory_governor.add("overlay", nbytes)
+                while self.total_bytes > self.max_bytes:
+                    self.pop_oldest()
+        return overlay
+
+    def pop_oldest(self):
+        # lock を持った状態で呼ぶ
+        _, overlay = self.entries.popitem(last=False)
+        self.total_bytes -= overlay.sizeInBytes()
+        memory_governor.release("overlay", overlay.sizeInBytes())
+        return overlay.sizeInBytes()
+
+    def reclaim(self, nbytes):
+        freed = 0
+        with self.lock:
+            while self.entries and freed < nbytes:
+                freed += self.pop_oldest()
+        return freed
+
+    def counts(self):
+        with self.lock:
+            return self.hits, self.misses
+
+    def clear(self):
+        with self.lock:
+            while self.entries:
+                self.pop_oldest()
+
+
+overlay_cache = OverlayCache(OverlayCache.DEFAULT_MB * 1024 * 1024)
+
+
+def hit_rate(hits, misses):
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+def render_cropped(image: QImage, crop, text, family, backgroundColor, fontColor, fontItalic, scale=1):
+    crop_x, crop_y, crop_w, crop_h, border = crop_layout(crop, scale)
+
+    with timed_stage("overlay"):
+        overlay = overlay_cache.get(crop_w, crop_h, border, text, family, backgroundColor, fontColor, fontItalic, scale)
+
+    with timed_stage("compose"):
+        # キャッシュのレイヤーを写して、写真を枠と文字の下に敷く
+        canvas = QImage(overlay)
+        painter = QPainter(canvas)
+        painter.setCompositionMode(QPainter.CompositionMode_DestinationOver)
+        painter.drawImage(QPoint(border, border), image, QRect(crop_x, crop_y, crop_w, crop_h))
+        painter.end()
 
-            cropped = self.pixmap.copy(crop_x, crop_y, crop_w, crop_h)
+    return canvas
 
-            border = max(50, crop_w // 8)
-            canvas = QPixmap(crop_w + border*2, crop_h + border*2)
-            canvas.fill(Qt.transparent)
 
-            painter = QPainter(canvas)
-            painter.setRenderHint(QPainter.Antialiasing)
+# ---- NumPy による合成 ----
+# 切り抜き・枠・余白付けを配列の操作で行う。QPainter で描いた場合と画素単位で同じ結果になるようにしている
+# - 枠の太さが奇数の時はアンチエイリアスの境目ができるので、枠だけ QPainter で同じ配列に描く
+# - 文字は Qt のフォントで同じ配列に直接1回だけ描く（グリフの形を QPainter 版と揃えるため）
+
+COMPOSITORS = ("qpainter", "numpy")
+
+
+def default_compositor():
+    return "numpy" if np_module() is not None else "qpainter"
+
+
+def array_view(image: QImage):
+    # QImage の画素を (高さ, 幅, 4) の配列として参照する（コピーしない）。並びは B, G, R, A
+    np = np_module()
+    bits = np.frombuffer(image.constBits(), np.uint8)
+    return bits.reshape(image.height(), image.bytesPerLine())[:, :image.width()*4].reshape(image.height(), image.width(), 4)
+
+
+def image_view(array):
+    # 配列をコピーせずに QImage として扱う。配列は QImage が使われている間、属性として保持しておく
+    height, width = array.shape[:2]
+    image = QImage(array.data, width, height, array.strides[0], QImage.Format_ARGB32_Premultiplied)
+    image._buffer = array
+    return image
+
+
+def pixel_view(array):
+    # (高さ, 幅, 4) の配列を1画素 = uint32 (0xAARRGGBB) として扱う
+    return array.view(np_module().uint32)[..., 0]
+
+
+def premultiplied_pixel(color: QColor):
+    # QImage.fill と同じ変換で、色を乗算済み ARGB の画素値にする
+    pixel = QImage(1, 1, QImage.Format_ARGB32_Premultiplied)
+    pixel.fill(color)
+    return int(pixel_view(array_view(pixel))[0, 0])
+
+
+def source_array(image: QImage):
+    # 不透明な RGB32 / RGBX8888 はそのまま、透過のある画像は乗算済み ARGB にしてから配列にする
+    # 戻り値: 配列, 配列が参照している QImage, 画素の並び（"rgb32" / "rgbx" / "premultiplied"）
+    if image.format() == QImage.Format_RGB32:
+        return array_view(image), image, "rgb32"
+    if image.format() == QImage.Format_RGBX8888:
+        return array_view(image), image, "rgbx"
+    if image.format() != QImage.Format_ARGB32_Premultiplied:
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    return array_view(image), image, "premultiplied"
+
+
+def copy_pixels(dst, src, kind):
+    # 透明・単色の下地への drawImage と同じ。不透明な画像はアルファを 0xff にしてコピー、乗算済み ARGB は SourceOver
+    if kind == "rgb32":
+        np_module().bitwise_or(pixel_view(src), 0xff000000, out=pixel_view(dst))
+    elif kind == "rgbx":
+        # R, G, B, X の並びを B, G, R, A に入れ替える
+        dst[..., 0] = src[..., 2]
+        dst[..., 1] = src[..., 1]
+        dst[..., 2] = src[..., 0]
+        dst[..., 3] = 255
+    else:
+        blend_over(dst, src)
+
+
+def blend_over(dst, src):
+    # 乗算済みアルファの SourceOver（Qt の BYTE_MUL と同じ丸め）。src は配列か画素値
+    np = np_module()
+    if isinstance(src, int):
+        if src >> 24 == 255:
+            pixel_view(dst)[...] = src
+            return
+        src = np.frombuffer(np.uint32(src).tobytes(), np.uint8)
+    alpha = src[..., 3:4]
+    if (alpha == 255).all():
+        dst[...] = src
+        return
+    x = dst.astype(np.uint32) * (255 - alpha)
+    x = (x + (x >> 8) + 0x80) >> 8
+    dst[...] = src + x.astype(np.uint8)
+
+
+def render_cropped_numpy(image: QImage, crop, text, family, backgroundColor, fontColor, fontItalic, scale=1):
+    np = np_module()
+    crop_x, crop_y, crop_w, crop_h, border = crop_layout(crop, scale)
+    src, keep, kind = source_array(image)
+
+    with timed_stage("overlay"):
+        overlay = overlay_cache.get(crop_w, crop_h, border, text, family, backgroundColor, fontColor, fontItalic, scale)
+
+    with timed_stage("crop"):
+        cropped = src[crop_y:crop_y + crop_h, crop_x:crop_x + crop_w]
+
+    with timed_stage("compose"):
+        layer = array_view(overlay)
+        covered = getattr(overlay, "_covered", None)
+        if covered is None:
+            # 写真の範囲でレイヤーに色がある画素（枠の掛かる端だけ）。レイヤーごとに1回だけ調べる
+            covered = overlay._covered = np.nonzero(layer[border:border + crop_h, border:border + crop_w, 3])
+
+        # 枠の部分はレイヤーを写し、写真の範囲は写真を写してから、色のある画素だけ写真の上に重ねる（DestinationOver）
+        canvas = np.empty_like(layer)
+        canvas[:border] = layer[:border]
+        canvas[border + crop_h:] = layer[border + crop_h:]
+        canvas[border:border + crop_h, :border] = layer[border:border + crop_h, :border]
+        canvas[border:border + crop_h, border + crop_w:] = layer[border:border + crop_h, border + crop_w:]
+        region = canvas[border:border + crop_h, border:border + crop_w]
+        if kind == "premultiplied":
+            region[...] = 0
+        copy_pixels(region, cropped, kind)
+        if len(covered[0]):
+            under = region[covered]
+            blend_over(under, layer[border:border + crop_h, border:border + crop_w][covered])
+            region[covered] = under
+
+    return image_view(canvas)
+
+
+def make_padded_image_numpy(image: QImage, bg_color: QColor, ratio=(4, 5)):
+    np = np_module()
+    new_w, new_h, x, y = padded_layout(image.width(), image.height(), ratio)
+    src, keep, kind = source_array(image)
+
+    with timed_stage("padded"):
+        canvas = np.empty((new_h, new_w, 4), np.uint8)
+        pixels = pixel_view(canvas)
+        color = premultiplied_pixel(bg_color)
+        if kind != "premultiplied":
+            # 写真で隠れる部分は塗らない
+            pixels[:y].fill(color)
+            pixels[y + image.height():].fill(color)
+            pixels[y:y + image.height(), :x].fill(color)
+            pixels[y:y + image.height(), x + image.width():].fill(color)
+        else:
+            pixels.fill(color)
+        copy_pixels(canvas[y:y + image.height(), x:x + image.width()], src, kind)
+
+    return image_view(canvas)
+
+
+def padded_layout(w, h, ratio=(4, 5)):
+    target_ratio = ratio[0] / ratio[1]
+
+    if w / h > target_ratio:
+        # 横が長い → 縦を伸ばす
+        new_w = w
+        new_h = int(w / target_ratio)
+    else:
+        # 縦が長い → 横を伸ばす
+        new_h = h
+        new_w = int(h * target_ratio)
+
+    x = (new_w - w) // 2
+    y = (new_h - h) // 2
+    return new_w, new_h, x, y
 
-            painter.drawPixmap(border, border, cropped)
 
-            # 枠
-            pen = QPen(self.backgroundColor, border)
-            pen.setJoinStyle(Qt.MiterJoin)
-            pen.setCapStyle(Qt.SquareCap)
-            painter.setPen(pen)
-            painter.drawRect(border//2, border//2, crop_w + border - 1, crop_h + border - 1)
+def make_padded_image(image: QImage, bg_color: QColor, ratio=(4, 5)):
+    new_w, new_h, x, y = padded_layout(image.width(), image.height(), ratio)
 
-            # 日付取得
-            text = self.text
+    with timed_stage("padded"):
+        canvas = QImage(new_w, new_h, QImage.Format_ARGB32_Premultiplied)
+        canvas.fill(bg_color)
+
+        painter = QPainter(canvas)
+        painter.drawImage(x, y, image)
+        painter.end()
+
+    return canvas
+
+
+def output_exif(src_path):
+    # 出力に埋め込む EXIF（元画像の EXIF + Software）
+    with timed_stage("exif"):
+        exif_bytes = read_metadata(src_path).exif_bytes
+    if not exif_bytes:
+        return None
+
+    # キャッシュを書き換えないよう、毎回新しい Exif を作る
+    exif = pil().Exif()
+    exif.load(exif_bytes)
+    exif[0x0131] = "aspectChange"        # Software
+    return exif
+
+
+def is_jpeg_path(path):
+    return os.path.splitext(path)[1].lower() in (".jpg", ".jpeg")
+
+
+# 出力形式: 拡張子 -> 形式名
+OUTPUT_FORMATS = {
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".png": "png",
+    ".webp": "webp",
+    ".avif": "avif",
+    ".bmp": "bmp",      # 入力と同じ形式で出力する時のため（圧縮しないので設定はない）
+}
+
+# 保存ダイアログのフィルタ（先頭の拡張子を、拡張子が付いていない時の既定にする）
+SAVE_FILTERS = [
+    ("JPEG Files", ".jpg", ".jpeg"),
+    ("PNG Files", ".png"),
+    ("WebP Files", ".webp"),
+    ("AVIF Files", ".avif"),
+]
+
+# エンコーダーの設定
+# PNG の strategies は zlib の圧縮方式の候補（Pillow では行ごとのフィルタは自動で選ばれ、指定できないため）
+# 候補が複数ある時は全部試して一番小さいものを使う
+# - 写真のようにノイズの多い画像は Z_RLE が一番小さく、圧縮レベルを上げても変わらない（しかも速い）
+# - 余白や文字の多い画像は Z_FILTERED を高いレベルで使う方が小さい
+# どちらの画像でも サイズ優先 <= バランス <= 速度優先 になるように、Z_RLE も候補に入れておく
+ENCODER_PRESETS = {
+    "fast": {
+        "jpeg": {"quality": 85, "subsampling": "4:2:0", "progressive": False, "optimize": False},
+        "png": {"compress_level": 1, "strategies": (zlib.Z_RLE,)},
+        "webp": {"quality": 85, "method": 0},
+        "avif": {"quality": 75, "speed": 10},
+        "bmp": {},
+    },
+    "balanced": {
+        "jpeg": {"quality": 90, "subsampling": "4:2:0", "progressive": False, "optimize": True},
+        "png": {"compress_level": 6, "strategies": (zlib.Z_FILTERED, zlib.Z_RLE)},
+        "webp": {"quality": 90, "method": 4},
+        "avif": {"quality": 80, "speed": 6},
+        "bmp": {},
+    },
+    "smallest": {
+        "jpeg": {"quality": 82, "subsampling": "4:2:0", "progressive": True, "optimize": True},
+        "png": {"compress_level": 9, "strategies": (zlib.Z_FILTERED, zlib.Z_RLE)},
+        "webp": {"quality": 80, "method": 6},
+        "avif": {"quality": 65, "speed": 4},
+        "bmp": {},
+    },
+}
+PRESET_NAMES = {"fast": "速度優先", "balanced": "バランス", "smallest": "サイズ優先"}
+DEFAULT_PRESET = "balanced"
+
+
+def output_format(path):
+    fmt = OUTPUT_FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise ValueError(f"対応していない出力形式です: {path}")
+    return fmt
+
+
+def encoder_params(path, preset=DEFAULT_PRESET):
+    # Pillow の save() に渡す引数の候補（PNG は圧縮方式ごと、それ以外は1つ）
+    fmt = output_format(path)
+    params = dict(ENCODER_PRESETS.get(preset, ENCODER_PRESETS[DEFAULT_PRESET])[fmt])
+    if fmt == "png":
+        strategies = params.pop("strategies")
+        return [dict(params, compress_type=strategy) for strategy in strategies]
+    return [params]
+
+
+def save_filter_string():
+    return ";;".join(f"{name} ({' '.join('*' + ext for ext in exts)})" for name, *exts in SAVE_FILTERS)
+
+
+def with_default_extension(path, selected_filter):
+    # 拡張子なしで保存先が入力された時は、選んだフィルタの形式にする
+    if os.path.splitext(path)[1].lower() in OUTPUT_FORMATS:
+        return path
+    for name, *exts in SAVE_FILTERS:
+        if selected_filter.startswith(name):
+            return path + exts[0]
+    return path + ".png"
+
+
+def qimage_to_pil(image: QImage, path):
+    # 戻り値の Image は rgba のメモリを参照しているので、rgba も一緒に返す
+    rgba = image.convertToFormat(QImage.Format_RGBA8888)
+    image = pil().frombuffer("RGBA", (rgba.width(), rgba.height()), rgba.constBits(), "raw", "RGBA", rgba.bytesPerLine(), 1)
+    if is_jpeg_path(path):
+        image = image.convert("RGB")
+    return image, rgba
+
+
+def save_pil(image, path, exif=None, preset=DEFAULT_PRESET, icc_profile=None):
+    # メモリ上にエンコードし、出力先への書き込みは output_writer に任せる（戻り値は書き込みの Future）
+    buffer = None
+    for params in encoder_params(path, preset):
+        if exif:
+            params["exif"] = exif
+        if icc_profile:
+            params["icc_profile"] = icc_profile
+        candidate = io.BytesIO()
+        image.save(candidate, output_format(path).upper(), **params)
+        if buffer is None or candidate.tell() < buffer.tell():
+            buffer = candidate
+    return output_writer.submit(path, buffer.getbuffer())
+
+
+def save_image(image: QImage, path, exif=None, preset=DEFAULT_PRESET, icc_profile=None):
+    # QImage を Pillow に渡し、EXIF ごと1回だけエンコードする
+    converted, rgba = qimage_to_pil(image, path)
+    return save_pil(converted, path, exif, preset, icc_profile)
+
+
+# ---- 後ろ書き（エンコード済みのデータを別スレッドで出力先に書き込む） ----
+# 出力先が NAS などで遅くても、次の画像のエンコードを止めないようにする
+# - 出力先のフォルダに一時ファイルを書いてから os.replace で置き換えるので、途中で落ちても書きかけのファイルは残らない
+# - 溜まっている分をまとめて書いてから fsync し、フォルダの fsync もまとめて1回にする
+
+class OutputWriter:
+    MAX_BATCH = 16
+    DEFAULT_PENDING_MB = 256
+
+    def __init__(self, max_pending_bytes=DEFAULT_PENDING_MB * 1024 * 1024, durable=True):
+        self.max_pending_bytes = max_pending_bytes
+        self.durable = durable
+        self.cond = threading.Condition()
+        self.queue = deque()        # (出力先, データ, スプールファイル, Future)
+        self.pending_bytes = 0      # 書き込み待ちのデータの大きさ（メモリ上の分）
+        self.pending_count = 0      # 書き込み待ち・書き込み中のファイル数
+        self.futures = {}           # 出力先 -> 最後に受け付けた書き込みの Future
+        self.thread = None
+        self.seq = 0
+
+    def submit(self, path, data=None, spool=None):
+        # data（bytes など）か、ローカルに書いたスプールファイルのどちらかを渡す
+        from concurrent.futures import Future
+        future = Future()
+        size = len(data) if data is not None else 0
+        with self.cond:
+            # 書き込み待ちのデータが多すぎる時は、減るまでエンコード側を待たせる
+            while self.pending_bytes and self.pending_bytes + size > self.max_pending_bytes:
+                self.cond.wait()
+            self.queue.append((path, data, spool, future))
+            self.pending_bytes += size
+            memory_governor.add("write", size)
+            self.pending_count += 1
+            self.futures[os.path.abspath(path)] = future
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="output-writer", daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+        return future
+
+    def take(self, paths):
+        # 出力先ごとの書き込みの Future を受け取る（受け取った分は記録から外す）
+        with self.cond:
+            return [f for f in (self.futures.pop(os.path.abspath(p), None) for p in paths) if f is not None]
+
+    def status(self):
+        with self.cond:
+            return self.pending_count, self.pending_bytes
+
+    def flush(self):
+        with self.cond:
+            while self.pending_count:
+                self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), self.MAX_BATCH))]
             try:
-                img = Image.open(self.filepath)
-                exif_data = img._getexif()
-                if exif_data:
-                    for tag_id, value in exif_data.items():
-                        tag = ExifTags.TAGS.get(tag_id)
-                        if tag == "DateTimeOriginal":
-                            # YYYY:MM:DD HH:MM:SS → MM月DD日
-                            date_parts = value.split()[0].split(":")
-                            mapping = {
-                                r"%year%": date_parts[0],
-                                r"%month%": date_parts[1],
-                                r"%day%": date_parts[2],
-                                r"%comment%": self.comment
-                            }
-
-                            for k, v in mapping.items():
-                                text = text.replace(k, v)
-                            break
+                errors = self.write_batch(batch)
             except Exception as e:
-                print("EXIF 読み込み失敗:", e)
+                errors = {path: e for path, data, spool, future in batch}
+            with self.cond:
+                for path, data, spool, future in batch:
+                    size = len(data) if data is not None else 0
+                    self.pending_bytes -= size
+                    self.pending_count -= 1
+                    memory_governor.release("write", size)
+                self.cond.notify_all()
+            for path, data, spool, future in batch:
+                if path in errors:
+                    future.set_exception(errors[path])
+                else:
+                    future.set_result(path)
+
+    def temp_path(self, path):
+        self.seq += 1
+        folder, name = os.path.split(path)
+        return os.path.join(folder, f".{name}.{os.getpid()}-{self.seq}.tmp")
+
+    def write_batch(self, batch):
+        errors = {}
+        staged = []     # (出力先, 一時ファイル)
+        for path, data, spool, future in batch:
+            temp = self.temp_path(path)
+            try:
+                if data is not None:
+                    with open(temp, "wb") as f:
+                        f.write(data)
+                else:
+                    try:
+                        os.replace(spool, temp)     # 同じドライブなら移動だけで済む
+                    except OSError:
+                        import shutil
+                        shutil.copyfile(spool, temp)
+                        os.remove(spool)
+                staged.append((path, temp))
+            except OSError as e:
+                errors[path] = e
+                for leftover in (temp, spool):
+                    if leftover and os.path.exists(leftover):
+                        os.remove(leftover)
+
+        if self.durable:
+            # 先にすべて書いておき、後からまとめて fsync する（書き戻しが重なるので1つずつより速い）
+            for path, temp in list(staged):
+                try:
+                    with open(temp, "rb+") as f:
+                        os.fsync(f.fileno())
+                except OSError as e:
+                    errors[path] = e
+                    staged.remove((path, temp))
+                    os.remove(temp)
+
+        folders = set()
+        for path, temp in staged:
+            try:
+                os.replace(temp, path)
+                folders.add(os.path.dirname(os.path.abspath(path)))
+            except OSError as e:
+                errors[path] = e
+                os.remove(temp)
+
+        if self.durable and os.name != "nt":
+            # 名前の変更を確定させる（Windows ではフォルダを開けないので行わない）
+            for folder in folders:
+                try:
+                    fd = os.open(folder, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+        return errors
+
+
+output_writer = OutputWriter()
+
+
+def spool_path(path):
+    # ストリップ処理の PNG など、メモリに置かずに書く出力はローカルのキャッシュフォルダに一旦書く
+    folder = os.path.join(app_cache_dir(), "spool")
+    os.makedirs(folder, exist_ok=True)
+    import tempfile
+    fd, spool = tempfile.mkstemp(suffix=os.path.splitext(path)[1], dir=folder)
+    os.close(fd)
+    return spool
+
+
+def when_written(futures, callback):
+    # すべての書き込みが終わったら callback(エラーの文字列、なければ None) を呼ぶ（書き込みスレッドから呼ばれる）
+    if not futures:
+        callback(None)
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        callback(str(errors[0]) if errors else None)
 
-            #前後の空白を削除
-            text = text.strip()
+    for future in futures:
+        future.add_done_callback(done)
 
-            # 左下に文字描画
-            if text:
-                font_size = max(18, crop_h //30)
-                font = QFont(self.font_family, font_size)
-                font.setItalic(self.fontItalic)
-                painter.setFont(font)
-                painter.setPen(QPen(self.fontColor))
 
-                # 余白計算
-                left_margin = 100
-                top_margin = font_size * 2.5       # 上に2行分余白（見た目調整用）
+def wait_written(futures):
+    # 書き込みが終わるまで待つ（失敗していれば例外を送出する）
+    for future in futures:
+        future.result()
 
-                # 描画 y座標 = キャンバス高さ - 下余白
-                y_pos = border + crop_h + top_margin
-                painter.drawText(left_margin, y_pos, text)
 
+def padded_path_for(save_path):
+    base, ext = os.path.splitext(save_path)
+    return base + "_padded" + ext
+
+
+# ---- 出力プロファイル（比率・サイズ違いの出力を1回のデコードからまとめて作る） ----
+# "4:5@1080x1350" のように 比率[@幅x高さ][/pad] で書く
+# - @幅x高さ は縮小後の上限（省略すると元の解像度のまま。拡大はしない）
+# - /pad は切り抜かずに余白を付けて比率を合わせる（省略時は切り抜いて枠と文字を付ける）
+# 元の解像度の 4:5 は従来どおりのファイル名（切り抜きは保存先そのまま、余白付きは _padded）で出力する
+
+DEFAULT_PROFILE_SPECS = ["4:5", "4:5/pad"]
+
+
+def parse_profile(spec):
+    text, _, mode = spec.strip().partition("/")
+    mode = mode or "crop"
+    ratio_text, _, size_text = text.partition("@")
+    try:
+        ratio = tuple(int(v) for v in ratio_text.split(":"))
+        size = tuple(int(v) for v in size_text.lower().split("x")) if size_text else None
+    except ValueError:
+        ratio = size = ()
+    if mode not in ("crop", "pad") or len(ratio) != 2 or min(ratio) <= 0 or (size is not None and (len(size) != 2 or min(size) <= 0)):
+        raise ValueError(f"出力プロファイルの形式が正しくありません: {spec}")
+
+    if ratio == (4, 5) and size is None:
+        name = "" if mode == "crop" else "padded"
+    else:
+        name = f"{ratio[0]}x{ratio[1]}" + (f"_{size[0]}x{size[1]}" if size else "") + ("_padded" if mode == "pad" else "")
+    return {"spec": spec.strip(), "name": name, "ratio": ratio, "size": size, "mode": mode}
+
+
+def profile_specs(options):
+    return list(options.get("profiles") or DEFAULT_PROFILE_SPECS)
 
-            painter.end()
 
-            if self.save_path:
-                canvas.save(self.save_path)
-            
-            # --- 余白付き（非トリミング）画像 ---
-            padded = self.make_padded_pixmap(self.pixmap, self.backgroundColor)
+def split_profile_specs(text):
+    # 設定では "4:5, 4:5/pad, 1:1@1080x1080" のようにカンマ区切りで保存する
+    return [spec.strip() for spec in text.split(",") if spec.strip()]
 
-            base, ext = os.path.splitext(self.save_path)
-            padded_path = base + "_padded" + ext
 
-            padded.save(padded_path)
+def profile_argument(spec):
+    # コマンドラインの --output-profile の検査用
+    try:
+        return parse_profile(spec)["spec"]
+    except ValueError as e:
+        import argparse
+        raise argparse.ArgumentTypeError(str(e))
 
-            self.copy_exif(self.filepath, self.save_path)
-            self.copy_exif(self.filepath, padded_path)
 
+def output_profiles(options):
+    # 同じファイル名になるプロファイルは最初のものだけを使う
+    profiles = {}
+    for spec in profile_specs(options):
+        profile = parse_profile(spec)
+        profiles.setdefault(profile["name"], profile)
+    return list(profiles.values())
+
+
+def profile_path(save_path, profile):
+    if not profile["name"]:
+        return save_path
+    base, ext = os.path.splitext(save_path)
+    return f"{base}_{profile['name']}{ext}"
+
+
+def output_paths(save_path, options):
+    return [profile_path(save_path, profile) for profile in output_profiles(options)]
+
+
+def profile_crop(crop, ratio, src_w, src_h):
+    # 画面で決めた枠と中心を揃え、同じ高さで指定の比率にする（画像からはみ出す時は収まるまで縮める）
+    x, y, w, h = crop
+    if abs(w / h - ratio[0] / ratio[1]) < 1e-3:
+        return crop
+    new_h = h
+    new_w = h * ratio[0] / ratio[1]
+    fit = min(1, src_w / new_w, src_h / new_h)
+    new_w *= fit
+    new_h *= fit
+    new_x = max(0, min(x + w / 2 - new_w / 2, src_w - new_w))
+    new_y = max(0, min(y + h / 2 - new_h / 2, src_h - new_h))
+    return new_x, new_y, new_w, new_h
+
+
+def profile_canvas_size(profile, crop, src_w, src_h):
+    # 縮小する前の出力の大きさ
+    if profile["mode"] == "pad":
+        pad_w, pad_h, _, _ = padded_layout(src_w, src_h, profile["ratio"])
+        return pad_w, pad_h
+    _, _, crop_w, crop_h, border = crop_layout(profile_crop(crop, profile["ratio"], src_w, src_h))
+    return crop_w + border*2, crop_h + border*2
+
+
+def downscale_size(width, height, size):
+    # size の枠に収まる大きさ（縦横比は保ち、拡大はしない）
+    scale = min(1, size[0] / width, size[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def downscale_pil(image, size):
+    # 整数分の1の縮小（Image.reduce、画素の平均なので速い）で目標の2倍程度まで縮めてから、最後に LANCZOS で仕上げる
+    target = downscale_size(image.width, image.height, size)
+    if target == image.size:
+        return image
+    factor = min(image.width // target[0], image.height // target[1]) // 2
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image.resize(target, pil().LANCZOS)
+
+
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+def encode_pool():
+    # 出力ごとの縮小・エンコードを並列に行うスレッドプール（Pillow は縮小・エンコード中に GIL を解放する）
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _encode_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="encode")
+    return _encode_pool
+
+
+def add_stage_time(name, seconds):
+    # 別スレッドで測った時間を、このスレッドのタイマーに足す
+    timer = getattr(_timing, "timer", None)
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+def encode_stage(profile):
+    if profile["name"] == "":
+        return "encode_cropped"
+    return "encode_" + profile["name"]
+
+
+def encode_variant(image, rgba, path, size, exif, preset, stage, icc_profile=None):
+    # rgba は image が参照しているメモリ（エンコードが終わるまで持っておく）
+    timings = {}
+    if size is not None:
+        t0 = time.perf_counter()
+        image = downscale_pil(image, size)
+        timings["resize"] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    save_pil(image, path, exif, preset, icc_profile)
+    timings[stage] = time.perf_counter() - t0
+    return timings
+
+
+def export_image(image: QImage, crop, save_path, filepath, comment, options, profiles=None, scale=1):
+    # options: text, family, backgroundColor, fontColor, fontItalic, encoderPreset, compositor, profiles, colorMode
+    # scale: image が縮小デコードした画像の時の倍率（枠と文字は元の解像度の見た目に合わせる）
+    # 合成はこのスレッドで順に行い、縮小とエンコードは encode_pool で並列に行う
+    preset = options.get("encoderPreset", DEFAULT_PRESET)
+    use_numpy = options.get("compositor", default_compositor()) == "numpy" and np_module() is not None
+    if profiles is None:
+        profiles = output_profiles(options)
+    text = expand_template(options["text"], filepath, comment) if any(p["mode"] == "crop" for p in profiles) else ""
+    exif = output_exif(filepath)
+    icc_profile = output_icc_profile(filepath, options)
+    src_w, src_h = image.width(), image.height()
+
+    futures = []
+    for profile in profiles:
+        path = profile_path(save_path, profile)
+        if profile["mode"] == "crop":
+            variant_crop = profile_crop(crop, profile["ratio"], src_w, src_h)
+            canvas = (render_cropped_numpy if use_numpy else render_cropped)(image, variant_crop, text, options["family"], options["backgroundColor"], options["fontColor"], options["fontItalic"], scale)
+        else:
+            canvas = (make_padded_image_numpy if use_numpy else make_padded_image)(image, options["backgroundColor"], profile["ratio"])
+        with timed_stage("convert"):
+            converted, rgba = qimage_to_pil(canvas, path)
+        del canvas
+        futures.append((path, encode_pool().submit(encode_variant, converted, rgba, path, profile["size"], exif, preset, encode_stage(profile), icc_profile)))
+        del converted, rgba
+
+    # 失敗したものがあっても、他の出力が書き終わるまで待ってから知らせる
+    from concurrent.futures import wait
+    wait([future for _, future in futures])
+    outputs = []
+    for path, future in futures:
+        for name, seconds in future.result().items():
+            add_stage_time(name, seconds)
+        outputs.append(path)
+    return outputs
+
+
+# ---- 大きな画像用：帯（ストリップ）単位で合成・書き出しを行い、メモリ使用量を抑える ----
+
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+
+def estimate_export_bytes(src_w, src_h, crop, profiles=None):
+    # メモリ上で一度に合成した場合のおおよそのピーク（4バイト/px）
+    # 元画像 + 出力ごとに（切り抜き）+ 合成結果 + Pillow への受け渡し分（エンコードは並列なので全部が同時に残りうる）
+    total = src_w * src_h
+    for profile in profiles or output_profiles({}):
+        canvas_w, canvas_h = profile_canvas_size(profile, crop, src_w, src_h)
+        total += canvas_w * canvas_h * 2
+        if profile["mode"] == "crop":
+            _, _, crop_w, crop_h, _ = crop_layout(profile_crop(crop, profile["ratio"], src_w, src_h))
+            total += crop_w * crop_h
+    return 4 * total
+
+
+class SourceStripReader:
+    # 元画像から必要な行だけを読み込む
+    # ClipRect に対応した形式（JPEG など）は部分デコード、それ以外は一度だけ全体をデコードして使い回す
+    # 部分デコードは毎回ファイルの先頭からデコードし直すので、band_bytes までの全幅の帯をまとめて読んでおき、
+    # 帯に入っている間のストリップはそこから切り出す（デコードし直す回数は帯の数だけになる）
+    def __init__(self, filepath, color_mode=DEFAULT_COLOR_MODE, band_bytes=0):
+        self.filepath = filepath
+        self.color_mode = color_mode
+        self.band_bytes = band_bytes
+        self.band = None        # (先頭の行, 全幅の帯の QImage)
+        reader = QImageReader(filepath)
+        self.size = reader.size()
+        if not self.size.isValid():
+            raise ValueError(reader.errorString())
+        self.clip = reader.supportsOption(QImageIOHandler.ClipRect)
+        # ファイルから読んだ部分は、読んだ分だけ sRGB に変換する
+        self.icc_profile = read_metadata(filepath).icc_profile if color_mode == "srgb" else None
+        # すでにデコード済みなら、部分デコードせずにそこから切り出す
+        self.source = source_registry.peek(filepath, color_mode)
+
+    def read(self, rect: QRect):
+        with timed_stage("decode"):
+            return self.read_rect(rect)
+
+    def read_rect(self, rect: QRect):
+        if self.source is None and self.clip:
+            band_y, band = self.band_for(rect)
+            return band.copy(rect.translated(0, -band_y))
+
+        if self.source is None:
+            self.source = open_source(self.filepath, self.color_mode)
+        return self.source.qimage().copy(rect)
+
+    def band_for(self, rect: QRect):
+        if self.band is not None:
+            band_y, band = self.band
+            if band_y <= rect.top() and rect.bottom() < band_y + band.height():
+                return self.band
+        self.band = None    # 次の帯を読む前に手放す
+        width = self.size.width()
+        rows = max(rect.height(), self.band_bytes // (4 * width))
+        rows = min(rows, self.size.height() - rect.top())
+        reader = QImageReader(self.filepath)
+        reader.setClipRect(QRect(0, rect.top(), width, rows))
+        image = reader.read()
+        if image.isNull():
+            raise ValueError(reader.errorString())
+        self.band = (rect.top(), convert_to_srgb(image, self.icc_profile))
+        return self.band
+
+    def read_scaled(self, scale):
+        # 縮小して出力するだけなら、縮小デコード（JPEG は DCT の段階で縮小）で済ませ、元の解像度の画像は作らない
+        size = QSize(max(1, round(self.size.width() * scale)), max(1, round(self.size.height() * scale)))
+        with timed_stage("decode"):
+            if self.source is not None:
+                return self.source.qimage().scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            reader = QImageReader(self.filepath)
+            reader.setScaledSize(size)
+            image = reader.read()
+            if image.isNull():
+                raise ValueError(reader.errorString())
+            return convert_to_srgb(image, self.icc_profile)
+
+
+class PngStripWriter:
+    # ストリップごとに圧縮しながら書き込む PNG ライター（画像全体をメモリに持たない）
+    def __init__(self, path, width, height, exif=None, compress_level=6, filter=zlib.Z_DEFAULT_STRATEGY, icc_profile=None):
+        self.path = path
+        self.width = width
+        self.compressor = zlib.compressobj(compress_level, zlib.DEFLATED, zlib.MAX_WBITS, 9, filter)
+        self.fp = open(path, "wb")
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))    # 8bit RGBA
+        if icc_profile:
+            self.chunk(b"iCCP", b"ICC Profile\x00\x00" + zlib.compress(icc_profile))   # 名前, 圧縮方式(0), 圧縮したプロファイル
+        if exif:
+            data = exif.tobytes()
+            if data.startswith(b"Exif\x00\x00"):
+                data = data[6:]
+            self.chunk(b"eXIf", data)
+
+    def chunk(self, tag, data):
+        self.fp.write(struct.pack(">I", len(data)) + tag + data)
+        self.fp.write(struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+    def write_strip(self, image: QImage):
+        rgba = image.convertToFormat(QImage.Format_RGBA8888)
+        bits = rgba.constBits()
+        bpl = rgba.bytesPerLine()
+        row_bytes = self.width * 4
+
+        data = bytearray()
+        for y in range(rgba.height()):
+            data += b"\x00"            # フィルタなし
+            data += bits[y*bpl : y*bpl + row_bytes]
+        compressed = self.compressor.compress(bytes(data))
+        if compressed:
+            self.chunk(b"IDAT", compressed)
+
+    def close(self):
+        self.chunk(b"IDAT", self.compressor.flush())
+        self.chunk(b"IEND", b"")
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # 書きかけのファイルは残さない
+            self.fp.close()
+            os.remove(self.path)
+
+
+def write_strips(path, width, height, strip_rows, paint, exif, stage, preset=DEFAULT_PRESET, icc_profile=None):
+    # paint(strip, y0) で描いた帯を順に書き出す（stage は計測用の段階名）
+    # PNG はそのままストリームで圧縮、それ以外の形式は Pillow の画像（JPEG は3バイト/px）に貼り合わせて1回だけエンコードする
+    if output_format(path) == "png":
+        # 行ごとのフィルタをかけないので、圧縮方式は Z_DEFAULT_STRATEGY が一番小さい（Z_RLE だと 1.5 倍になる）
+        params = ENCODER_PRESETS.get(preset, ENCODER_PRESETS[DEFAULT_PRESET])["png"]
+        spool = spool_path(path)
+        with PngStripWriter(spool, width, height, exif, params["compress_level"], zlib.Z_DEFAULT_STRATEGY, icc_profile) as writer:
+            for y0 in range(0, height, strip_rows):
+                with timed_stage("compose"):
+                    strip = QImage(width, min(strip_rows, height - y0), QImage.Format_ARGB32_Premultiplied)
+                    paint(strip, y0)
+                with timed_stage(stage):
+                    writer.write_strip(strip)
+        return output_writer.submit(path, spool=spool)
+
+    # 貼り合わせた画像と、エンコード結果のバッファ（BMP では同じ大きさになる）はストリップの予算の外なので、別に数える
+    nbytes = 2 * width * height * (3 if is_jpeg_path(path) else 4)
+    memory_governor.make_room(nbytes)
+    memory_governor.add("export", nbytes)
+    try:
+        out = pil().new("RGB" if is_jpeg_path(path) else "RGBA", (width, height))
+        for y0 in range(0, height, strip_rows):
+            with timed_stage("compose"):
+                strip = QImage(width, min(strip_rows, height - y0), QImage.Format_ARGB32_Premultiplied)
+                paint(strip, y0)
+                converted, rgba = qimage_to_pil(strip, path)
+                out.paste(converted, (0, y0))
+        with timed_stage(stage):
+            return save_pil(out, path, exif, preset, icc_profile)
+    finally:
+        memory_governor.release("export", nbytes)
+
+
+def export_image_strips(reader, crop, save_path, filepath, comment, options, budget_bytes, profiles):
+    # 元の解像度のまま出力するプロファイルを、帯ごとに読み込み・合成しながら書き出す
+    preset = options.get("encoderPreset", DEFAULT_PRESET)
+    text = expand_template(options["text"], filepath, comment)
+    exif = output_exif(filepath)
+    icc_profile = output_icc_profile(filepath, options)
+    src_w = reader.size.width()
+    src_h = reader.size.height()
+
+    def strip_rows_for(width):
+        # 予算の1/4を1本の帯（合成用 + 元画像の該当行 + 変換用）に使う
+        return max(64, int(budget_bytes / 4 / (width * 4 * 3)))
+
+    def cropped_painter(variant_crop):
+        crop_x, crop_y, crop_w, crop_h, border = crop_layout(variant_crop)
+
+        def paint_cropped(strip, y0):
+            strip.fill(Qt.transparent)
+            painter = QPainter(strip)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.translate(0, -y0)
+
+            r0 = max(y0, border)
+            r1 = min(y0 + strip.height(), border + crop_h)
+            if r1 > r0:
+                part = reader.read(QRect(crop_x, crop_y + r0 - border, crop_w, r1 - r0))
+                painter.drawImage(border, r0, part)
+
+            paint_frame(painter, crop_w, crop_h, border, text, options["family"], options["backgroundColor"], options["fontColor"], options["fontItalic"])
+            painter.end()
+        return paint_cropped
+
+    def padded_painter(pad_x, pad_y):
+        def paint_padded(strip, y0):
+            strip.fill(options["backgroundColor"])
+            r0 = max(y0, pad_y)
+            r1 = min(y0 + strip.height(), pad_y + src_h)
+            if r1 > r0:
+                painter = QPainter(strip)
+                part = reader.read(QRect(0, r0 - pad_y, src_w, r1 - r0))
+                painter.drawImage(pad_x, r0 - y0, part)
+                painter.end()
+        return paint_padded
+
+    outputs = []
+    for profile in profiles:
+        path = profile_path(save_path, profile)
+        if profile["mode"] == "crop":
+            variant_crop = profile_crop(crop, profile["ratio"], src_w, src_h)
+            _, _, crop_w, crop_h, border = crop_layout(variant_crop)
+            width, height = crop_w + border*2, crop_h + border*2
+            paint = cropped_painter(variant_crop)
+        else:
+            width, height, pad_x, pad_y = padded_layout(src_w, src_h, profile["ratio"])
+            paint = padded_painter(pad_x, pad_y)
+        write_strips(path, width, height, strip_rows_for(width), paint, exif, encode_stage(profile), preset, icc_profile)
+        outputs.append(path)
+    return outputs
+
+
+def export_reduced(reader, crop, save_path, filepath, comment, options, profiles):
+    # 縮小して出力するプロファイルは、必要な大きさの2倍程度で縮小デコードした画像からまとめて作る
+    src_w = reader.size.width()
+    src_h = reader.size.height()
+    scale = 0
+    for profile in profiles:
+        canvas_w, canvas_h = profile_canvas_size(profile, crop, src_w, src_h)
+        scale = max(scale, min(profile["size"][0] / canvas_w, profile["size"][1] / canvas_h))
+    scale = min(1, scale * 2)
+    image = reader.read_scaled(scale)
+    sx = image.width() / src_w
+    sy = image.height() / src_h
+    x, y, w, h = crop
+    return export_image(image, (x * sx, y * sy, w * sx, h * sy), save_path, filepath, comment, options, profiles, sx)
+
+
+def export_file(filepath, crop, save_path, comment, options):
+    # すべてのプロファイルを1回のデコードから作る
+    # メモリ予算を超えそうな大きな画像だけ、元の解像度の出力はストリップ処理、縮小する出力は縮小デコードにする
+    # アプリ全体のメモリ上限の方が小さければ、そちらに合わせる
+    budget_bytes = min(options.get("memoryBudgetMB", DEFAULT_MEMORY_BUDGET_MB) * 1024 * 1024, memory_governor.budget)
+    profiles = output_profiles(options)
+    color_mode = options.get("colorMode", DEFAULT_COLOR_MODE)
+    # 帯単位の処理では、予算の半分を読み込んだ元画像の帯に使う（残りは合成用のストリップ）
+    reader = SourceStripReader(filepath, color_mode, budget_bytes // 2)
+    w, h = reader.size.width(), reader.size.height()
+    estimate = estimate_export_bytes(w, h, crop, profiles)
+    if reader.source is not None:
+        estimate -= 4 * w * h       # 元画像はデコード済みで、新たには使わない
+    if estimate > budget_bytes:
+        full = [p for p in profiles if p["size"] is None]
+        reduced = [p for p in profiles if p["size"] is not None]
+        with memory_governor.reservation(budget_bytes):
+            if full:
+                export_image_strips(reader, crop, save_path, filepath, comment, options, budget_bytes, full)
+            if reduced:
+                export_reduced(reader, crop, save_path, filepath, comment, options, reduced)
+        return [profile_path(save_path, p) for p in profiles]
+
+    # 元画像は共有の SourceImage から使う（同じファイルの出力が重なってもデコードは1回）
+    # 元画像はデコードした時に別に数えるので、予約するのは合成に使う分だけ
+    with memory_governor.reservation(estimate - (0 if reader.source is not None else 4 * w * h)):
+        source = reader.source or open_source(filepath, color_mode)
+        return export_image(source.qimage(), crop, save_path, filepath, comment, options, profiles)
+
+
+# ---- サイドカー（枠の位置とコメントを画像の横に保存し、設定を変えた時に出力し直せるようにする） ----
+
+MANIFEST_SUFFIX = ".aspectChange.json"
+MANIFEST_VERSION = 1
+# 出力の見た目に関わる設定だけをハッシュに入れる（合成処理やメモリ予算は結果が変わらないので入れない）
+RENDER_SETTING_KEYS = ("text", "family", "backgroundColor", "fontColor", "fontItalic", "encoderPreset", "profiles", "colorMode")
+_manifest_lock = threading.Lock()
+
+
+def manifest_path(filepath):
+    return filepath + MANIFEST_SUFFIX
+
+
+def load_manifest(filepath):
+    try:
+        with open(manifest_path(filepath), encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION:
+        return None
+    return data
+
+
+def save_manifest(filepath, data):
+    # 書きかけのファイルが残らないように、一時ファイルに書いてから置き換える
+    path = manifest_path(filepath)
+    temp = path + ".tmp"
+    try:
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(temp, path)
+    except OSError as e:
+        print(f"サイドカーを保存できませんでした: {path} ({e})")
+
+
+def source_hash(filepath, known=None):
+    # サイズと更新日時が記録と同じなら、読み直さずに記録のハッシュを使う
+    st = os.stat(filepath)
+    if known and known.get("size") == st.st_size and known.get("mtime_ns") == st.st_mtime_ns:
+        return known
+    h = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": h.hexdigest()}
+
+
+def manifest_crop(crop):
+    return [int(v) for v in crop]
+
+
+def image_size(filepath):
+    size = QImageReader(filepath).size()
+    return [size.width(), size.height()] if size.isValid() else None
+
+
+def manifest_crop_for(manifest, width, height):
+    # 記録した枠が今の画像に収まる時だけ返す
+    # 同じ名前の別の画像に置き換わった時などは None（枠を決め直す）
+    if not manifest or "crop" not in manifest:
+        return None
+    recorded = manifest.get("image_size")
+    if recorded and list(recorded) != [width, height]:
+        return None
+    try:
+        x, y, w, h = manifest_crop(manifest["crop"])
+    except (TypeError, ValueError):
+        return None
+    if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > width or y + h > height:
+        return None
+    return [x, y, w, h]
+
+
+def settings_hash(options, comment):
+    values = {"comment": comment}
+    for key in RENDER_SETTING_KEYS:
+        value = options.get(key)
+        if key in ("backgroundColor", "fontColor"):
+            value = QColor(value).name(QColor.HexArgb)
+        elif key == "profiles":
+            value = profile_specs(options)
+        elif key == "colorMode":
+            value = value or DEFAULT_COLOR_MODE
+        values[key] = value
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def output_hashes(source, crop, options, comment):
+    return {
+        "source": source["sha1"],
+        "crop": manifest_crop(crop),
+        "settings": settings_hash(options, comment),
+    }
+
+
+def save_crop_manifest(filepath, crop, comment):
+    # 出力していなくても、枠の位置とコメントだけは残しておく
+    with _manifest_lock:
+        data = load_manifest(filepath) or {"version": MANIFEST_VERSION, "outputs": {}}
+        data["crop"] = manifest_crop(crop)
+        data["image_size"] = image_size(filepath)
+        data["comment"] = comment
+        save_manifest(filepath, data)
+
+
+def export_record(filepath, crop, comment, options, save_path, outputs):
+    # 出力したファイルと、その時の元画像・枠・設定のハッシュをまとめる
+    # 元画像を読んでハッシュを取るので時間がかかる。GUI スレッドでは呼ばない
+    source = source_hash(filepath, (load_manifest(filepath) or {}).get("source"))
+    return {
+        "source": source,
+        "crop": manifest_crop(crop),
+        "image_size": image_size(filepath),
+        "comment": comment,
+        "save_path": os.path.abspath(save_path),
+        "entry": {
+            "files": [os.path.abspath(p) for p in outputs],
+            "hashes": output_hashes(source, crop, options, comment),
+        },
+    }
+
+
+def save_export_record(filepath, record):
+    # export_record で作った記録をサイドカーに書き込むだけ（ハッシュは計算しない）
+    with _manifest_lock:
+        data = load_manifest(filepath) or {"version": MANIFEST_VERSION, "outputs": {}}
+        for key in ("source", "crop", "image_size", "comment"):
+            data[key] = record[key]
+        data.setdefault("outputs", {})[record["save_path"]] = record["entry"]
+        save_manifest(filepath, data)
+
+
+def record_export(filepath, crop, comment, options, save_path, outputs):
+    save_export_record(filepath, export_record(filepath, crop, comment, options, save_path, outputs))
+
+
+def stale_outputs(filepath, data, options):
+    # 元画像・枠・設定のどれかが変わったか、ファイルが無くなった出力だけを返す
+    try:
+        source = source_hash(filepath, data.get("source"))
+    except OSError:
+        return []
+    current = output_hashes(source, data["crop"], options, data.get("comment", ""))
+    stale = []
+    for save_path, entry in data.get("outputs", {}).items():
+        files = entry.get("files", [save_path])
+        if entry.get("hashes") != current or not all(os.path.exists(p) for p in files):
+            stale.append(save_path)
+    return stale
+
+
+class ExportWorker(QObject):
+    finished = Signal(str)
+    error = Signal(str)
+    done = Signal(int, object, object)    # job_id, エラー（なければ None）, 段階ごとの所要時間
+
+    def __init__(self, crop, text, family, save_path, comment, filepath, backgroundColor, fontColor, fontItalic, memoryBudgetMB=DEFAULT_MEMORY_BUDGET_MB, encoderPreset=DEFAULT_PRESET, compositor=None, saveManifest=True, profiles=None, colorMode=DEFAULT_COLOR_MODE):
+        super().__init__()
+        self.crop = crop
+        self.text = text
+        self.font_family = family
+        self.save_path = save_path
+        self.comment = comment
+        self.filepath = filepath
+        self.backgroundColor = backgroundColor
+        self.fontColor = fontColor
+        self.fontItalic = fontItalic
+        self.memoryBudgetMB = memoryBudgetMB
+        self.encoderPreset = encoderPreset
+        self.compositor = compositor or default_compositor()
+        self.saveManifest = saveManifest
+        self.profiles = profiles
+        self.colorMode = colorMode
+        self.job_id = 0
+        self.writes = []        # 出力先への書き込み（エンコードが終わった時点ではまだ終わっていない）
+        self.record = None      # サイドカーに書く内容（書き込みが終わってから保存する）
 
+    def run(self):
+        error = None
+        result = None
+        try:
+            options = {
+                "text": self.text,
+                "family": self.font_family,
+                "backgroundColor": self.backgroundColor,
+                "fontColor": self.fontColor,
+                "fontItalic": self.fontItalic,
+                "memoryBudgetMB": self.memoryBudgetMB,
+                "encoderPreset": self.encoderPreset,
+                "compositor": self.compositor,
+                "profiles": self.profiles,
+                "colorMode": self.colorMode,
+            }
+            # 表示はプレビュー（縮小画像）なので、書き出し時に元画像を読み込む
+            timer = StageTimer()
+            with timer.active():
+                outputs = export_file(self.filepath, self.crop, self.save_path, self.comment, options)
+            result = timer.result()
+            self.writes = output_writer.take(outputs)
+            if self.saveManifest:
+                # 元画像のハッシュはこのスレッドで取っておき、GUI スレッドでは書き込むだけにする
+                try:
+                    self.record = export_record(self.filepath, self.crop, self.comment, options, self.save_path, outputs)
+                except Exception as e:
+                    print("サイドカーの保存に失敗しました:", e)
+            append_timing_log(timing_record(self.filepath, self.save_path, result))
         except Exception as e:
-            self.error.emit(str(e))
+            error = str(e)
+            self.error.emit(error)
         finally:
+            # 受け側では sender() を使わず、job_id で出力ジョブを特定する
+            # （別スレッドからのシグナルでは sender() が None になることがある）
+            self.done.emit(self.job_id, error, result)
             self.finished.emit(self.save_path)
 
-    def make_padded_pixmap(self, pixmap: QPixmap, bg_color: QColor):
-        w = pixmap.width()
-        h = pixmap.height()
+    def committed(self):
+        # 出力先への書き込みがすべて終わった後に、GUI スレッドで呼ばれる（ExportQueue.on_written）
+        if self.record is not None:
+            save_export_record(self.filepath, self.record)
+
+
+class ExportQueue(QObject):
+    # 出力ジョブの待ち行列。同時に動かすスレッド数は max_workers までに抑える
+    jobChanged = Signal(int)
+    jobFinished = Signal(int)
+    idle = Signal()
+    written = Signal(int, object)   # job_id, 書き込みのエラー（なければ None）
 
-        target_ratio = 4 / 5
+    PENDING = "待機中"
+    RUNNING = "出力中"
+    WRITING = "書き込み待ち"
+    DONE = "完了"
+    FAILED = "エラー"
 
-        if w / h > target_ratio:
-            # 横が長い → 縦を伸ばす
-            new_w = w
-            new_h = int(w / target_ratio)
+    def __init__(self, max_workers=2, parent=None):
+        super().__init__(parent)
+        self.max_workers = max(1, max_workers)
+        self.pending = deque()
+        self.running = {}       # job_id -> (thread, worker)
+        self.writing = {}       # job_id -> worker（エンコードが終わり、出力先への書き込みを待っている）
+        self.jobs = {}          # job_id -> {"state", "save_path", "error"}
+        self.next_id = 1
+        self.written.connect(self.on_written)
+
+    def submit(self, worker):
+        job_id = self.next_id
+        self.next_id += 1
+        worker.job_id = job_id
+        self.jobs[job_id] = {"state": self.PENDING, "save_path": worker.save_path, "error": None, "timings": None}
+        self.pending.append(worker)
+        self.jobChanged.emit(job_id)
+        self.start_next()
+        return job_id
+
+    def start_next(self):
+        while self.pending and len(self.running) < self.max_workers:
+            worker = self.pending.popleft()
+            thread = QThread(self)     # 親を持たせて、終了(deleteLater)まで破棄されないようにする
+            worker.moveToThread(thread)
+
+            thread.started.connect(worker.run)
+            worker.done.connect(self.on_done)
+            worker.finished.connect(thread.quit)
+
+            self.running[worker.job_id] = (thread, worker)
+            self.jobs[worker.job_id]["state"] = self.RUNNING
+            self.jobChanged.emit(worker.job_id)
+            thread.start()
+
+    def on_done(self, job_id, error, timings):
+        # スレッドが止まるのを待ってから枠を空ける（worker は running から外した時点で破棄される）
+        thread, worker = self.running.pop(job_id)
+        thread.quit()
+        thread.wait()
+        thread.deleteLater()
+
+        job = self.jobs[job_id]
+        job["timings"] = timings
+        if error is None:
+            # 書き込みは後ろで続けさせ、次のジョブのエンコードを先に始める
+            self.writing[job_id] = worker
+            job["state"] = self.WRITING
+            self.jobChanged.emit(job_id)
+            # 書き込みスレッドではシグナルを送るだけにする（サイドカーの記録などで次の書き込みを待たせない）
+            when_written(worker.writes, lambda write_error, job_id=job_id: self.written.emit(job_id, write_error))
         else:
-            # 縦が長い → 横を伸ばす
-            new_h = h
-            new_w = int(h * target_ratio)
+            self.finish_job(job_id, error)
 
-        canvas = QPixmap(new_w, new_h)
-        canvas.fill(bg_color)
+        self.start_next()
 
-        painter = QPainter(canvas)
-        x = (new_w - w) // 2
-        y = (new_h - h) // 2
-        painter.drawPixmap(x, y, pixmap)
-        painter.end()
+    def on_written(self, job_id, error):
+        worker = self.writing.pop(job_id)
+        if error is None:
+            # 出力は書き終わっているので、サイドカーの記録に失敗してもジョブは完了にする
+            try:
+                worker.committed()
+            except Exception as e:
+                print("サイドカーの保存に失敗しました:", e)
+        self.finish_job(job_id, error)
 
-        return canvas
-    
+    def finish_job(self, job_id, error):
+        job = self.jobs[job_id]
+        job["error"] = error
+        job["state"] = self.FAILED if error else self.DONE
+        self.jobChanged.emit(job_id)
+        self.jobFinished.emit(job_id)
+        if self.is_idle():
+            self.idle.emit()
 
-    def copy_exif(self, src_path, dst_path):
-        try:
-            src = Image.open(src_path)
-            exif = src.getexif()
+    def is_idle(self):
+        return not self.pending and not self.running and not self.writing
 
-            if not exif:
-                return
-            
-            exif[0x0131] = "aspectChange"        # Software
+    def counts(self):
+        states = [job["state"] for job in self.jobs.values()]
+        return {state: states.count(state) for state in (self.PENDING, self.RUNNING, self.WRITING, self.DONE, self.FAILED)}
+
+    def clear_finished(self):
+        for job_id in [k for k, job in self.jobs.items() if job["state"] in (self.DONE, self.FAILED)]:
+            del self.jobs[job_id]
 
-            dst = Image.open(dst_path)
-            dst.save(dst_path, exif=exif)
-        except Exception as e:
-            print("EXIF コピー失敗:", e)
+
+class ExportQueuePanel(QWidget):
+    # 出力ジョブの一覧（待機中・出力中・完了）
+    def __init__(self, queue, parent=None):
+        super().__init__(parent)
+        self.queue = queue
+        self.items = {}
+
+        self.summary = QLabel()
+        self.list = QListWidget()
+        clear = QPushButton("完了した項目を消去")
+        clear.clicked.connect(self.clear_finished)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.summary)
+        layout.addWidget(self.list)
+        layout.addWidget(clear)
+
+        queue.jobChanged.connect(self.update_job)
+        self.update_summary()
+
+    def update_job(self, job_id):
+        job = self.queue.jobs.get(job_id)
+        if job is None:
+            return
+        item = self.items.get(job_id)
+        if item is None:
+            item = QListWidgetItem()
+            self.list.addItem(item)
+            self.items[job_id] = item
+
+        text = f"[{job['state']}] {os.path.basename(job['save_path'])}"
+        if job["error"]:
+            text += f" ({job['error']})"
+        item.setText(text)
+        tooltip = job["save_path"]
+        if job["timings"]:
+            tooltip += "\n" + format_timings(job["timings"])
+        item.setToolTip(tooltip)
+        self.update_summary()
+
+    def update_summary(self):
+        c = self.queue.counts()
+        text = " / ".join(f"{state} {n}" for state, n in c.items())
+        files, pending = output_writer.status()
+        if files:
+            text += f"\n未書き込み {files} ファイル ({pending / 1024 / 1024:.1f}MB)"
+        self.summary.setText(text)
+
+    def clear_finished(self):
+        self.queue.clear_finished()
+        for job_id in [k for k in self.items if k not in self.queue.jobs]:
+            self.list.takeItem(self.list.row(self.items.pop(job_id)))
+        self.update_summary()
+
+
+# ---- バッチ処理（ウィンドウを使わずに複数ファイルを書き出す） ----
+
+_batch_app = None
+
+def _batch_init():
+    # ワーカープロセスごとにGUIなしのQGuiApplicationを用意する（フォント描画に必要）
+    global _batch_app
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    _batch_app = QGuiApplication.instance() or QGuiApplication([])
+    # 1ファイルにつき1回しか書き出さないので、デコード済みの画像は残さない
+    source_registry.set_max_bytes(0)
+
+
+def worker_options(options):
+    # プロセス間では色を文字列で受け渡すので、ワーカー側で QColor に戻す
+    opts = dict(options)
+    opts["backgroundColor"] = QColor(options["backgroundColor"])
+    opts["fontColor"] = QColor(options["fontColor"])
+    return opts
+
+
+def _batch_export_one(filepath, out_dir, comment, options):
+    try:
+        size = QImageReader(filepath).size()
+        if not size.isValid():
+            raise ValueError("画像を読み込めませんでした")
+        # サイドカーに枠が保存されていて、今の画像に収まればそれを使う
+        crop = manifest_crop_for(load_manifest(filepath), size.width(), size.height())
+        if crop is None:
+            crop = suggest_crop(filepath, size.width(), size.height(), options.get("autoCrop", True))
+        opts = worker_options(options)
+        save_path = batch_save_path(filepath, out_dir, options.get("format"))
+        timer = StageTimer()
+        with timer.active():
+            outputs = export_file(filepath, crop, save_path, comment, opts)
+        # このプロセスの書き込みが終わるまで待ってから結果を返す（他のプロセスはその間もエンコードを続ける）
+        wait_written(output_writer.take(outputs))
+        if options.get("saveManifest", True):
+            record_export(filepath, crop, comment, opts, save_path, outputs)
+        return filepath, outputs, None, timer.result()
+    except Exception as e:
+        return filepath, [], str(e), None
+
+
+def _rerender_one(filepath, save_paths, options):
+    # サイドカーの枠とコメントで、古くなった出力だけを書き出し直す
+    try:
+        manifest = load_manifest(filepath)
+        if manifest is None:
+            raise ValueError("サイドカーを読み込めませんでした")
+        size = QImageReader(filepath).size()
+        if not size.isValid():
+            raise ValueError("画像を読み込めませんでした")
+        # 画像が置き換わって枠が収まらなくなっていたら、枠を決め直す
+        crop = manifest_crop_for(manifest, size.width(), size.height())
+        if crop is None:
+            crop = suggest_crop(filepath, size.width(), size.height(), options.get("autoCrop", True))
+        comment = manifest.get("comment", "")
+        opts = worker_options(options)
+        outputs = []
+        timer = StageTimer()
+        with timer.active():
+            for save_path in save_paths:
+                written = export_file(filepath, crop, save_path, comment, opts)
+                wait_written(output_writer.take(written))
+                record_export(filepath, crop, comment, opts, save_path, written)
+                outputs += written
+        return filepath, outputs, None, timer.result()
+    except Exception as e:
+        return filepath, [], str(e), None
+
+
+def collect_inputs(inputs):
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    files.append(os.path.join(path, name))
+        else:
+            files.append(path)
+    return files
+
+
+def batch_save_path(filepath, out_dir, fmt=None):
+    save_path = os.path.join(out_dir, os.path.basename(filepath))
+    if fmt:
+        save_path = os.path.splitext(save_path)[0] + "." + fmt
+    return save_path
+
+
+def in_folder(filepath, folder):
+    try:
+        return os.path.samefile(os.path.dirname(os.path.abspath(filepath)), folder)
+    except OSError:
+        return False
+
+
+def check_batch_outputs(files, out_dir, options):
+    # 元の写真を上書きしたり、同じ名前の出力で上書きし合ったりしないか、書き出す前に確かめる（問題があればその内容を返す）
+    problems = []
+    owners = {}
+    for filepath in files:
+        if in_folder(filepath, out_dir):
+            problems.append(f"出力先が元画像と同じフォルダです: {filepath}")
+            continue
+        for path in output_paths(batch_save_path(filepath, out_dir, options.get("format")), options):
+            key = os.path.normcase(os.path.abspath(path))
+            if key in owners:
+                problems.append(f"出力先が重なっています: {owners[key]} と {filepath} -> {path}")
+            else:
+                owners[key] = filepath
+    return problems
+
+
+def load_export_options(settings):
+    # 色はプロセス間で受け渡せるように文字列にしておく
+    return {
+        "text": settings.value("textContent", "%year%.%month%.%day% %comment%"),
+        "family": settings.value("fontFamily", "Arial"),
+        "backgroundColor": QColor(settings.value("backgroundColor", QColor(244,235,255))).name(QColor.HexArgb),
+        "fontColor": QColor(settings.value("fontColor", QColor(0,0,10))).name(QColor.HexArgb),
+        "fontItalic": settings.value("fontItalic", False, bool),
+        "memoryBudgetMB": settings.value("memoryBudgetMB", DEFAULT_MEMORY_BUDGET_MB, int),
+        "encoderPreset": settings.value("encoderPreset", DEFAULT_PRESET),
+        "compositor": settings.value("compositor", default_compositor()),
+        "autoCrop": settings.value("autoCrop", True, bool),
+        "saveManifest": settings.value("saveManifest", True, bool),
+        "profiles": split_profile_specs(settings.value("outputProfiles", ", ".join(DEFAULT_PROFILE_SPECS))),
+        "colorMode": settings.value("colorMode", DEFAULT_COLOR_MODE),
+    }
+
+
+def add_export_arguments(parser, output_format=True, compositor=True):
+    # batch / rerender / watch で共通の出力設定（省略したものは GUI の設定を使う）
+    # 起動時の --profile（cProfile での計測）と重ならないように、出力プロファイルは --output-profile にする
+    import argparse
+    parser.add_argument("--preset", choices=sorted(ENCODER_PRESETS), default=None, help="エンコーダーの設定（省略時は GUI の設定）")
+    if output_format:
+        parser.add_argument("--format", choices=["jpg", "png", "webp", "avif"], default=None, help="出力形式（省略時は入力と同じ）")
+        parser.add_argument("--auto-crop", action=argparse.BooleanOptionalAction, default=None, help="枠を自動で配置する（省略時は GUI の設定）")
+    if compositor:
+        parser.add_argument("--compositor", choices=COMPOSITORS, default=None, help="合成処理（numpy は QPainter と同じ結果をより速く作る。省略時は設定値）")
+    parser.add_argument("--output-profile", action="append", type=profile_argument, default=None, help="出力プロファイル（例: 4:5@1080x1350, 1:1@1080x1080/pad, 9:16）。複数指定可。省略時は GUI の設定")
+    parser.add_argument("--color", choices=sorted(COLOR_MODES), default=None, help="埋め込みの ICC プロファイルの扱い（srgb: sRGB に変換、keep: 元のプロファイルを埋め込む。省略時は GUI の設定）")
+
+
+def apply_export_overrides(options, args):
+    # add_export_arguments で指定されたものだけ、GUI の設定を上書きする
+    if args.preset is not None:
+        options["encoderPreset"] = args.preset
+    if hasattr(args, "format"):
+        options["format"] = args.format
+        if args.auto_crop is not None:
+            options["autoCrop"] = args.auto_crop
+    if getattr(args, "compositor", None) is not None:
+        options["compositor"] = args.compositor
+    if args.output_profile:
+        options["profiles"] = args.output_profile
+    if args.color is not None:
+        options["colorMode"] = args.color
+
+
+def run_batch(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="aspectChange batch", description="ウィンドウを開かずに画像をまとめて書き出します")
+    parser.add_argument("inputs", nargs="+", help="入力画像またはフォルダ")
+    parser.add_argument("--out", required=True, help="出力フォルダ")
+    parser.add_argument("--comment", default="", help="%%comment%% に入れる文字列")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument("--memory-budget", type=int, default=None, help="全ワーカー合計のメモリ予算 (MB)。超えそうな画像はストリップ処理で書き出す")
+    parser.add_argument("--timings", action="store_true", help="ファイルごとに段階別の処理時間を表示する")
+    parser.add_argument("--no-manifest", action="store_true", help="サイドカー（枠の位置と出力の記録）を保存しない")
+    add_export_arguments(parser)
+    args = parser.parse_args(argv)
+
+    files = collect_inputs(args.inputs)
+    if not files:
+        print("入力画像がありません")
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+
+    options = load_export_options(QSettings("HoshiYakiImo", "aspectChange"))
+    jobs = max(1, min(args.jobs, len(files)))
+    if args.memory_budget is not None:
+        options["memoryBudgetMB"] = args.memory_budget
+    apply_export_overrides(options, args)
+    if args.no_manifest:
+        options["saveManifest"] = False
+    # 予算はワーカー数で割って1ジョブあたりの上限にする
+    options["memoryBudgetMB"] = max(1, options["memoryBudgetMB"] // jobs)
+
+    problems = check_batch_outputs(files, args.out, options)
+    if problems:
+        for problem in problems:
+            print(problem)
+        print("元の写真や他の出力を上書きしないよう、何も書き出さずに終了します（--out に別のフォルダを指定してください）")
+        return 1
+
+    ok = 0
+    failed = 0
+    counts = {}
+    start = time.perf_counter()
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_batch_init) as pool:
+        futures = [pool.submit(_batch_export_one, f, args.out, args.comment, options) for f in files]
+        for future in as_completed(futures):
+            filepath, outputs, error, timings = future.result()
+            if error is None:
+                ok += 1
+                for name, n in timings.get("counts", {}).items():
+                    counts[name] = counts.get(name, 0) + n
+                print(f"[OK] {filepath} -> {', '.join(outputs)}")
+                append_timing_log(timing_record(filepath, outputs[0], timings))
+                if args.timings:
+                    print(f"     {format_timings(timings)}")
+            else:
+                failed += 1
+                print(f"[NG] {filepath}: {error}")
+    elapsed = time.perf_counter() - start
+
+    print(f"完了: 成功 {ok} / 失敗 {failed} / {elapsed:.2f}秒 ({ok / elapsed:.2f} images/s)")
+    print_overlay_rate(counts)
+    return 0 if failed == 0 else 1
+
+
+def print_overlay_rate(counts):
+    hits = counts.get("overlay_hit", 0)
+    misses = counts.get("overlay_miss", 0)
+    if hits + misses:
+        print(f"枠と文字のキャッシュ: ヒット率 {hit_rate(hits, misses):.0%} ({hits} / {hits + misses})")
+
+
+def run_rerender(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="aspectChange rerender", description="サイドカーに記録した枠とコメントで、設定の変わった出力だけを書き出し直します")
+    parser.add_argument("inputs", nargs="+", help="入力画像またはフォルダ")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument("--force", action="store_true", help="変更がなくてもすべて書き出し直す")
+    parser.add_argument("--dry-run", action="store_true", help="書き出し直す出力を表示するだけにする")
+    add_export_arguments(parser, output_format=False)
+    args = parser.parse_args(argv)
+
+    options = load_export_options(QSettings("HoshiYakiImo", "aspectChange"))
+    apply_export_overrides(options, args)
+
+    # 変更の判定はハッシュの比較だけなので、先にまとめて済ませる
+    tasks = []
+    skipped = 0
+    for filepath in collect_inputs(args.inputs):
+        manifest = load_manifest(filepath)
+        if manifest is None or "crop" not in manifest:
+            continue
+        outputs = list(manifest.get("outputs", {}))
+        stale = outputs if args.force else stale_outputs(filepath, manifest, options)
+        skipped += len(outputs) - len(stale)
+        if stale:
+            tasks.append((filepath, stale))
+    print(f"書き出し直し: {sum(len(s) for _, s in tasks)} / 変更なし: {skipped}")
+    if args.dry_run:
+        for filepath, stale in tasks:
+            for save_path in stale:
+                print(f"  {filepath} -> {save_path}")
+        return 0
+    if not tasks:
+        return 0
+
+    jobs = max(1, min(args.jobs, len(tasks)))
+    options["memoryBudgetMB"] = max(1, options["memoryBudgetMB"] // jobs)
+
+    ok = 0
+    failed = 0
+    counts = {}
+    start = time.perf_counter()
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_batch_init) as pool:
+        futures = [pool.submit(_rerender_one, filepath, stale, options) for filepath, stale in tasks]
+        for future in as_completed(futures):
+            filepath, outputs, error, timings = future.result()
+            if error is None:
+                ok += 1
+                for name, n in timings.get("counts", {}).items():
+                    counts[name] = counts.get(name, 0) + n
+                print(f"[OK] {filepath} -> {', '.join(outputs)}")
+            else:
+                failed += 1
+                print(f"[NG] {filepath}: {error}")
+    elapsed = time.perf_counter() - start
+
+    print(f"完了: 成功 {ok} / 失敗 {failed} / {elapsed:.2f}秒")
+    print_overlay_rate(counts)
+    return 0 if failed == 0 else 1
+
+
+# ---- フォルダ監視（テザー撮影など、次々に追加される画像を自動で書き出す） ----
+
+class ProcessedRecord:
+    # 書き出し済みファイルの記録。再起動しても同じファイルを処理し直さないように app_data_dir に追記していく
+    # キーはパス・サイズ・更新日時なので、上書きされたファイルは処理し直す
+    FILE_NAME = "watch_processed.jsonl"
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(app_data_dir(), self.FILE_NAME)
+        self.keys = set()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.keys.add((entry["path"], entry["size"], entry["mtime_ns"]))
+                    except (ValueError, KeyError):
+                        continue
+        except OSError:
+            pass
+
+    @staticmethod
+    def key(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    def __contains__(self, path):
+        try:
+            return self.key(path) in self.keys
+        except OSError:
+            return False
+
+    def add(self, path, outputs=()):
+        # 出力先が監視フォルダの中でも拾い直さないよう、出力ファイルも記録する
+        with open(self.path, "a", encoding="utf-8") as f:
+            for p in [path, *outputs]:
+                try:
+                    key = self.key(p)
+                except OSError:
+                    continue
+                self.keys.add(key)
+                f.write(json.dumps({"path": key[0], "size": key[1], "mtime_ns": key[2], "source": os.path.abspath(path)}, ensure_ascii=False) + "\n")
+
+
+def looks_complete(path):
+    # JPEG は終端マーカー (FFD9) まで書き込まれているかを見る。他の形式はサイズが落ち着いたかどうかだけで判断する
+    if not is_jpeg_path(path):
+        return True
+    try:
+        with open(path, "rb") as f:
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == b"\xff\xd9"
+    except OSError:
+        return False
+
+
+class FolderWatcher(QObject):
+    # フォルダに追加された画像を ExportQueue で順に書き出す
+    # - QFileSystemWatcher の通知で走査し、通知が来ない環境（ネットワークドライブなど）向けに一定間隔でも走査する
+    # - 書き込み途中のファイルは、サイズと更新日時が settle 秒変わらなくなるまで待つ
+    # - キューに入れるのは同時に max_in_flight 件まで。残りはパスだけ控えておく（大量に追加されてもメモリを使い切らない）
+    fileProcessed = Signal(str, list)
+    fileFailed = Signal(str, str)
+    stopped = Signal()
+
+    SETTLE_CHECK_MS = 250
+    INCOMPLETE_TIMEOUT = 30.0   # 終端マーカーがないまま、この秒数サイズが変わらなければ諦めて処理する
+
+    def __init__(self, folder, out_dir, comment, options, max_workers=2, poll_interval=2.0, settle=1.0, use_notifications=True, parent=None):
+        super().__init__(parent)
+        self.folder = os.path.abspath(folder)
+        self.out_dir = out_dir
+        self.comment = comment
+        self.options = options
+        self.settle = settle
+        self.max_in_flight = max(1, max_workers) * 2
+        self.record = ProcessedRecord()
+        self.candidates = {}        # path -> (size, mtime_ns, 変化がなくなった時刻)
+        self.ready = deque()        # 書き出し待ちのパス
+        self.queued = set()         # ready とキューにあるパス
+        self.failed = set()
+        self.in_flight = {}         # job_id -> 元画像のパス
+        self.stopping = False
+
+        self.queue = ExportQueue(max_workers, self)
+        self.queue.jobFinished.connect(self.on_job_finished)
+        self.queue.idle.connect(self.on_idle)
+
+        self.scanTimer = QTimer(self)
+        self.scanTimer.setSingleShot(True)
+        self.scanTimer.setInterval(200)
+        self.scanTimer.timeout.connect(self.scan)
+
+        self.settleTimer = QTimer(self)
+        self.settleTimer.setInterval(self.SETTLE_CHECK_MS)
+        self.settleTimer.timeout.connect(self.check_candidates)
+
+        self.pollTimer = QTimer(self)
+        self.pollTimer.setInterval(int(poll_interval * 1000))
+        self.pollTimer.timeout.connect(self.scan)
+
+        self.watcher = None
+        if use_notifications:
+            self.watcher = QFileSystemWatcher(self)
+            if self.watcher.addPath(self.folder):
+                self.watcher.directoryChanged.connect(lambda path: self.scanTimer.start())
+            else:
+                print("フォルダの変更通知を使えないため、定期的な走査だけで監視します")
+                self.watcher = None
+
+    def start(self):
+        self.pollTimer.start()
+        self.scan()
+
+    def stop(self):
+        # 待ちのファイルは捨て、実行中の書き出しが終わったら stopped を出す
+        self.stopping = True
+        self.pollTimer.stop()
+        self.settleTimer.stop()
+        self.scanTimer.stop()
+        self.ready.clear()
+        self.queue.pending.clear()
+        if self.queue.is_idle():
+            self.stopped.emit()
+
+    def scan(self):
+        if self.stopping:
+            return
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError as e:
+            print(f"フォルダを読めませんでした: {e}")
+            return
+        for entry in entries:
+            path = entry.path
+            if not entry.name.lower().endswith(IMAGE_EXTENSIONS) or path in self.queued or path in self.candidates or path in self.failed:
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if not entry.is_file() or path in self.record:
+                continue
+            self.candidates[path] = (st.st_size, st.st_mtime_ns, time.monotonic())
+        if self.candidates:
+            self.settleTimer.start()
+
+    def check_candidates(self):
+        now = time.monotonic()
+        for path, (size, mtime_ns, since) in list(self.candidates.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.candidates[path]      # 途中で消された
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                self.candidates[path] = (st.st_size, st.st_mtime_ns, now)
+                continue
+            stable = now - since
+            if st.st_size == 0 or stable < self.settle:
+                continue
+            if not looks_complete(path) and stable < self.INCOMPLETE_TIMEOUT:
+                continue
+            del self.candidates[path]
+            self.ready.append(path)
+            self.queued.add(path)
+        if not self.candidates:
+            self.settleTimer.stop()
+        self.pump()
+
+    def pump(self):
+        while self.ready and len(self.in_flight) < self.max_in_flight and not self.stopping:
+            path = self.ready.popleft()
+            try:
+                worker = self.make_worker(path)
+            except Exception as e:
+                self.queued.discard(path)
+                self.failed.add(path)
+                self.fileFailed.emit(path, str(e))
+                continue
+            job_id = self.queue.submit(worker)
+            self.in_flight[job_id] = path
+
+    def make_worker(self, path):
+        size = QImageReader(path).size()
+        if not size.isValid():
+            raise ValueError("画像を読み込めませんでした")
+        if in_folder(path, self.out_dir):
+            raise ValueError("出力先が元画像と同じフォルダなので、上書きしないよう書き出しません")
+        save_path = batch_save_path(path, self.out_dir, self.options.get("format"))
+        o = self.options
+        crop = manifest_crop_for(load_manifest(path), size.width(), size.height())
+        if crop is None:
+            crop = suggest_crop(path, size.width(), size.height(), o.get("autoCrop", True))
+        return ExportWorker(crop, o["text"], o["family"], save_path, self.comment, path,
+                            QColor(o["backgroundColor"]), QColor(o["fontColor"]), o["fontItalic"],
+                            o["memoryBudgetMB"], o["encoderPreset"], o["compositor"], o.get("saveManifest", True), o.get("profiles"),
+                            o.get("colorMode", DEFAULT_COLOR_MODE))
+
+    def on_job_finished(self, job_id):
+        path = self.in_flight.pop(job_id)
+        job = self.queue.jobs.pop(job_id)
+        self.queued.discard(path)
+        if job["error"] is None:
+            outputs = output_paths(job["save_path"], self.options)
+            self.record.add(path, outputs)
+            self.fileProcessed.emit(path, outputs)
+        else:
+            self.failed.add(path)
+            self.fileFailed.emit(path, job["error"])
+        self.pump()
+
+    def on_idle(self):
+        if self.stopping:
+            self.stopped.emit()
+
+    def backlog(self):
+        return len(self.candidates) + len(self.ready) + len(self.in_flight)
+
+
+def run_watch(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="aspectChange watch", description="フォルダを監視し、追加された画像を設定に従って書き出します（Ctrl+C で終了）")
+    parser.add_argument("folder", help="監視するフォルダ")
+    parser.add_argument("--out", default=None, help="出力フォルダ（省略時は GUI で設定した出力先）")
+    parser.add_argument("--comment", default="", help="%%comment%% に入れる文字列")
+    parser.add_argument("--jobs", type=int, default=2, help="同時に書き出す枚数")
+    parser.add_argument("--poll", type=float, default=2.0, help="フォルダを走査する間隔（秒）")
+    parser.add_argument("--settle", type=float, default=1.0, help="ファイルの書き込みが終わったとみなすまでの待ち時間（秒）")
+    parser.add_argument("--no-notify", action="store_true", help="変更通知を使わず、定期的な走査だけで監視する")
+    add_export_arguments(parser, compositor=False)
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.folder):
+        print(f"フォルダがありません: {args.folder}")
+        return 1
+
+    settings = QSettings("HoshiYakiImo", "aspectChange")
+    out_dir = args.out or settings.value("exportFolder", "")
+    if not out_dir:
+        print("出力フォルダを --out か GUI の設定で指定してください")
+        return 1
+    os.makedirs(out_dir, exist_ok=True)
+    if os.path.samefile(args.folder, out_dir):
+        # GUI の出力先が撮影フォルダのままだと、届いた写真を切り抜いた画像で上書きしてしまう
+        print(f"出力先が監視するフォルダと同じです: {out_dir}")
+        print("元の写真を上書きしないよう、--out に別のフォルダを指定してください")
+        return 1
+
+    options = load_export_options(settings)
+    jobs = max(1, args.jobs)
+    options["memoryBudgetMB"] = max(1, options["memoryBudgetMB"] // jobs)
+    apply_export_overrides(options, args)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QGuiApplication.instance() or QGuiApplication([])
+    source_registry.set_max_bytes(0)
+
+    watcher = FolderWatcher(args.folder, out_dir, args.comment, options, jobs, args.poll, args.settle, not args.no_notify)
+    watcher.fileProcessed.connect(lambda path, outputs: print(f"[OK] {path} -> {', '.join(outputs)}  (残り {watcher.backlog()})", flush=True))
+    watcher.fileFailed.connect(lambda path, error: print(f"[NG] {path}: {error}", flush=True))
+    watcher.stopped.connect(app.quit)
+
+    # Ctrl+C で止める（Python のシグナルハンドラが動くように、定期的にイベントループから戻す）
+    import signal
+    signal.signal(signal.SIGINT, lambda *a: watcher.stop())
+    wake = QTimer()
+    wake.start(200)
+    wake.timeout.connect(lambda: None)
+
+    print(f"{os.path.abspath(args.folder)} を監視しています → {out_dir}", flush=True)
+    watcher.start()
+    app.exec()
+    print("監視を終了しました")
+    return 0
 
 
 
 
 
 class MainWindow(QMainWindow):
+    firstPainted = Signal()
+
     def __init__(self, File = None, parent=None):
         # 親クラスの初期化
         super().__init__(parent)
@@ -418,16 +3790,51 @@ class MainWindow(QMainWindow):
         self.viewExportCompletedDialog = self.settings.value("viewExportCompletedDialog", True, bool)
         self.currentOpenFileDir = self.settings.value("currentOpenFileDir", "", str)
         self.lockOpenFileDir = self.settings.value("lockOpenFileDir", False, bool)
+        self.exportWorkers = self.settings.value("exportWorkers", 2, int)
+        self.previewCacheMB = self.settings.value("previewCacheMB", 256, int)
+        self.sourceCacheMB = self.settings.value("sourceCacheMB", SourceRegistry.DEFAULT_MB, int)
+        source_registry.set_max_bytes(self.sourceCacheMB * 1024 * 1024)
+        self.memoryBudgetMB = self.settings.value("memoryBudgetMB", DEFAULT_MEMORY_BUDGET_MB, int)
+        self.showExportTimings = self.settings.value("showExportTimings", False, bool)
+        self.encoderPreset = self.settings.value("encoderPreset", DEFAULT_PRESET, str)
+        if self.encoderPreset not in ENCODER_PRESETS:
+            self.encoderPreset = DEFAULT_PRESET
+        self.colorMode = self.settings.value("colorMode", DEFAULT_COLOR_MODE, str)
+        if self.colorMode not in COLOR_MODES:
+            self.colorMode = DEFAULT_COLOR_MODE
+        self.exportFilter = self.settings.value("exportFilter", "", str)
+        self.compositor = self.settings.value("compositor", default_compositor(), str)
+        self.autoCrop = self.settings.value("autoCrop", True, bool)
+        self.saveManifest = self.settings.value("saveManifest", True, bool)
+        self.outputProfiles = self.settings.value("outputProfiles", ", ".join(DEFAULT_PROFILE_SPECS), str)
+        self.loadedComment = None   # 表示中の画像を開いた時のコメント（変わった時だけサイドカーを書く）
+        self.appMemoryMB = self.settings.value("appMemoryMB", MemoryGovernor.DEFAULT_MB, int)
+        memory_governor.set_budget(self.appMemoryMB * 1024 * 1024)
+        self.diskCacheMB = self.settings.value("diskCacheMB", DiskPreviewCache.DEFAULT_MB, int)
+        preview_disk_cache.set_max_bytes(self.diskCacheMB * 1024 * 1024)
+        self.sessionFiles = []
+        self.sessionIndex = -1
+        self.fontDialog = None
+        self.textTemplateDialog = None
+        self.painted = False
+        self.closeRequested = False
+
+        self.exportQueue = ExportQueue(self.exportWorkers, self)
+        self.exportQueue.jobFinished.connect(self.finish_export)
+        self.exportQueue.idle.connect(self.export_queue_idle)
 
         self.Makewindow()
+        self.exportQueue.jobChanged.connect(self.update_write_status)
 
-        self.view.fileDropped.connect(self.loadedFile)
+        self.view.filesDropped.connect(self.open_files)
+        self.view.imageLoaded.connect(self.previewReady)
+        self.view.loadFailed.connect(self.previewFailed)
 
         if File == None:
             self.No_file()
             #self.file_open()
         else:
-            self.loadedFile(File)
+            self.open_files([File])
 
     def Makewindow(self):
         self.setWindowTitle("aspectChange")
@@ -443,6 +3850,14 @@ class MainWindow(QMainWindow):
         mSetting = MenuBar.addMenu("設定")
         self.acOpenFile = QAction("開く", self)
         self.acOpenFile.triggered.connect(self.file_open)
+        self.acOpenFolder = QAction("フォルダを開く", self)
+        self.acOpenFolder.triggered.connect(self.folder_open)
+        self.acNextImage = QAction("次の画像", self)
+        self.acNextImage.setShortcuts([QKeySequence(Qt.Key_Right), QKeySequence(Qt.Key_PageDown)])
+        self.acNextImage.triggered.connect(self.next_image)
+        self.acPrevImage = QAction("前の画像", self)
+        self.acPrevImage.setShortcuts([QKeySequence(Qt.Key_Left), QKeySequence(Qt.Key_PageUp)])
+        self.acPrevImage.triggered.connect(self.prev_image)
         self.acSetExportFolder = QAction("出力フォルダの選択", self)
         self.acSetExportFolder.triggered.connect(self.set_export_folder)
         self.acSetFont = QAction("フォントの選択", self)
@@ -456,13 +3871,67 @@ class MainWindow(QMainWindow):
         self.acViewExportCompletedDialog = QAction("出力完了時のダイアログ表示")
         self.acViewExportCompletedDialog.setCheckable(True)
         self.acViewExportCompletedDialog.triggered.connect(self.view_export_completed_dialog)
+        self.acSetMemoryBudget = QAction("メモリ予算の設定", self)
+        self.acSetMemoryBudget.triggered.connect(self.set_memory_budget)
+        self.acSetAppMemory = QAction("アプリ全体のメモリ上限", self)
+        self.acSetAppMemory.triggered.connect(self.set_app_memory)
+        self.acShowExportTimings = QAction("出力の処理時間を表示", self)
+        self.acShowExportTimings.setCheckable(True)
+        self.acShowExportTimings.setChecked(self.showExportTimings)
+        self.acShowExportTimings.triggered.connect(self.show_export_timings)
+        self.acSetDiskCache = QAction("プレビューのキャッシュ容量", self)
+        self.acSetDiskCache.triggered.connect(self.set_disk_cache)
+        self.acAutoCrop = QAction("枠を自動で配置", self)
+        self.acAutoCrop.setCheckable(True)
+        self.acAutoCrop.setChecked(self.autoCrop)
+        self.acAutoCrop.triggered.connect(self.set_auto_crop)
+        self.acSaveManifest = QAction("枠の位置をサイドカーに保存", self)
+        self.acSaveManifest.setCheckable(True)
+        self.acSaveManifest.setChecked(self.saveManifest)
+        self.acSaveManifest.triggered.connect(self.set_save_manifest)
+        self.acSetOutputProfiles = QAction("出力プロファイルの設定", self)
+        self.acSetOutputProfiles.triggered.connect(self.set_output_profiles)
+        self.mEncoderPreset = QMenu("出力の画質", self)
+        self.encoderPresetGroup = QActionGroup(self)
+        for preset, label in PRESET_NAMES.items():
+            action = QAction(label, self)
+            action.setCheckable(True)
+            action.setChecked(preset == self.encoderPreset)
+            action.setData(preset)
+            self.encoderPresetGroup.addAction(action)
+            self.mEncoderPreset.addAction(action)
+        self.encoderPresetGroup.triggered.connect(self.set_encoder_preset)
+        self.mColorMode = QMenu("ICC プロファイルの扱い", self)
+        self.colorModeGroup = QActionGroup(self)
+        for mode, label in COLOR_MODES.items():
+            action = QAction(label, self)
+            action.setCheckable(True)
+            action.setChecked(mode == self.colorMode)
+            action.setData(mode)
+            self.colorModeGroup.addAction(action)
+            self.mColorMode.addAction(action)
+        self.colorModeGroup.triggered.connect(self.set_color_mode)
         mFile.addAction(self.acOpenFile)
+        mFile.addAction(self.acOpenFolder)
+        mFile.addSeparator()
+        mFile.addAction(self.acNextImage)
+        mFile.addAction(self.acPrevImage)
+        mFile.addSeparator()
         mSetting.addAction(self.acSetExportFolder)
         mSetting.addAction(self.acSetFont)
         mSetting.addAction(self.acSetTextTemplete)
         mSetting.addAction(self.acSetBackgroundColor)
         mSetting.addAction(self.acSetFontColor)
         mSetting.addAction(self.acViewExportCompletedDialog)
+        mSetting.addAction(self.acSetMemoryBudget)
+        mSetting.addAction(self.acSetAppMemory)
+        mSetting.addAction(self.acShowExportTimings)
+        mSetting.addMenu(self.mEncoderPreset)
+        mSetting.addMenu(self.mColorMode)
+        mSetting.addAction(self.acSetOutputProfiles)
+        mSetting.addAction(self.acAutoCrop)
+        mSetting.addAction(self.acSaveManifest)
+        mSetting.addAction(self.acSetDiskCache)
 
         # Makewindow 内
         self.comment_input = QLineEdit()
@@ -472,9 +3941,15 @@ class MainWindow(QMainWindow):
         self.export = QPushButton("出力")
         self.export.clicked.connect(self.Export)
 
-        self.view = CropView()
+        self.view = CropView(self.previewCacheMB * 1024 * 1024)
+        self.view.auto_crop = self.autoCrop
+
+        self.filmstrip = Filmstrip()
+        self.filmstrip.currentRowChanged.connect(self.show_index)
+        self.filmstrip.hide()
 
         self.MainWinMainLayout.addWidget(self.view)
+        self.MainWinMainLayout.addWidget(self.filmstrip)
         self.MainWinMainLayout.addLayout(self.underLayout)
         self.underLayout.addWidget(self.comment_input)
         self.underLayout.addWidget(self.export)
@@ -482,26 +3957,111 @@ class MainWindow(QMainWindow):
         centralWidget.setLayout(self.MainWinMainLayout)
         self.setCentralWidget(centralWidget)
 
+        self.queuePanel = ExportQueuePanel(self.exportQueue)
+        self.queueDock = QDockWidget("出力キュー", self)
+        self.queueDock.setWidget(self.queuePanel)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.queueDock)
+        mFile.addAction(self.queueDock.toggleViewAction())
+
+        self.writeStatus = QLabel()
+        self.statusBar.addPermanentWidget(self.writeStatus)
+        self.memoryStatus = QLabel()
+        self.statusBar.addPermanentWidget(self.memoryStatus)
+        self.memoryTimer = QTimer(self)
+        self.memoryTimer.timeout.connect(self.update_memory_status)
+        self.memoryTimer.start(1000)
+
         self.statusBar.showMessage("正常に起動しました")
 
     def file_open(self):
         try:
-            Filename, tmp = QFileDialog.getOpenFileName(self,"ファイルを開く",self.currentOpenFileDir,"Image File (*.jpeg *.jpg *.png *.bmp)")
-            self.currentOpenFileDir = os.path.dirname(Filename)
-            self.settings.setValue("currentOpenFileDir", self.currentOpenFileDir)
+            Filenames, tmp = QFileDialog.getOpenFileNames(self,"ファイルを開く",self.currentOpenFileDir,"Image File (*.jpeg *.jpg *.png *.bmp)")
+            if Filenames:
+                self.currentOpenFileDir = os.path.dirname(Filenames[0])
+                self.settings.setValue("currentOpenFileDir", self.currentOpenFileDir)
         except FileNotFoundError:
             self.statusBar.showMessage("ファイルが選択されませんでした")
             return
-        if Filename == "":
+        if not Filenames:
+            return
+        self.open_files(Filenames)
+
+    def folder_open(self):
+        folder = QFileDialog.getExistingDirectory(self, "フォルダを開く", self.currentOpenFileDir, QFileDialog.ShowDirsOnly)
+        if not folder:
+            return
+        self.currentOpenFileDir = folder
+        self.settings.setValue("currentOpenFileDir", self.currentOpenFileDir)
+        self.open_files([folder])
+
+    def open_files(self, paths):
+        # 複数ファイル・フォルダをまとめて開き、セッションとして切り替えられるようにする
+        files = [f for f in collect_inputs(paths) if f.lower().endswith(IMAGE_EXTENSIONS)]
+        if not files:
+            self.statusBar.showMessage("画像ファイルが見つかりませんでした")
             return
-        self.loadedFile(Filename)
+
+        self.sessionFiles = files
+        self.sessionIndex = -1
+        self.filmstrip.blockSignals(True)
+        self.filmstrip.set_files(files)
+        self.filmstrip.blockSignals(False)
+        self.filmstrip.setVisible(len(files) > 1)
+        self.show_index(0)
+
+    def show_index(self, index):
+        if not (0 <= index < len(self.sessionFiles)) or index == self.sessionIndex:
+            return
+        self.sessionIndex = index
+        self.filmstrip.blockSignals(True)
+        self.filmstrip.setCurrentRow(index)
+        self.filmstrip.blockSignals(False)
+
+        self.loadedFile(self.sessionFiles[index])
+
+        # 前後の画像を先読みしておく
+        neighbours = [self.sessionFiles[i] for i in (index + 1, index - 1) if 0 <= i < len(self.sessionFiles)]
+        self.view.prefetch(neighbours)
+
+    def next_image(self):
+        self.show_index(self.sessionIndex + 1)
+
+    def prev_image(self):
+        self.show_index(self.sessionIndex - 1)
 
     def loadedFile(self, Filename):
+        self.save_current_crop()
+        self.statusBar.showMessage(f"読み込み中…… - {Filename}")
         self.view.load_image(Filename)
+
+    def previewReady(self, Filename):
         self.currentWindowTitle = f"aspectChange - {os.path.basename(Filename)}"
         self.setWindowTitle(self.currentWindowTitle)
         self.statusBar.showMessage(f"ファイルが開かれました - {Filename}")
         self.export.setDisabled(False)
+        # 前に保存した枠の位置とコメントがあれば戻す
+        manifest = load_manifest(Filename) if self.saveManifest else None
+        if manifest and "crop" in manifest:
+            source_size = self.view.source_size
+            crop = manifest_crop_for(manifest, source_size.width(), source_size.height())
+            if crop is not None:
+                self.view.set_crop_geometry(crop)
+            self.comment_input.setText(manifest.get("comment", ""))
+        self.loadedComment = self.comment_input.text()
+
+    def save_current_crop(self):
+        # 枠を手で動かしたかコメントを変えた時だけ、別の画像に移る前にサイドカーへ保存する
+        view = self.view
+        if not self.saveManifest or view.current_file is None or view.crop_rect is None:
+            return
+        comment = self.comment_input.text()
+        if view.crop_adjusted or comment != self.loadedComment:
+            save_crop_manifest(view.current_file, view.crop_geometry(), comment)
+            view.crop_adjusted = False
+            self.loadedComment = comment
+
+    def previewFailed(self, Filename, detail):
+        self.statusBar.showMessage(f"ファイルを開けませんでした({detail}) - {Filename}")
 
     def set_export_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "出力フォルダを選択", "", QFileDialog.ShowDirsOnly)
@@ -512,8 +4072,12 @@ class MainWindow(QMainWindow):
 
     def set_font(self):
         italic = False if str(self.fontItalic) == "False" else True
-        print(self.fontItalic)
-        dlg = FontFamilyDialog(italic, self)
+        # ダイアログは初めて使う時に作り、以降は使い回す
+        sample = sample_text(self.textContent, self.comment_input.text())
+        if self.fontDialog is None:
+            self.fontDialog = FontFamilyDialog(italic, sample, self)
+        dlg = self.fontDialog
+        dlg.prepare(italic, sample, self.settings.value("fontFamily", "Arial"))
         if dlg.exec():
             family = dlg.selected_family()
             italic = dlg.selected_italic()
@@ -525,7 +4089,10 @@ class MainWindow(QMainWindow):
                 self.statusBar.showMessage(f"フォントを{family}に、イタリックを{italic}に設定しました")
 
     def set_text_template(self):
-        dlg = TextTemplateDialog(self.textContent, self)
+        if self.textTemplateDialog is None:
+            self.textTemplateDialog = TextTemplateDialog(self.textContent, self)
+        dlg = self.textTemplateDialog
+        dlg.edit.setPlainText(self.textContent)
         if dlg.exec():
             self.textContent = dlg.text()
             self.settings.setValue("textContent", self.textContent)
@@ -549,60 +4116,176 @@ class MainWindow(QMainWindow):
         self.viewExportCompletedDialog = checked
         self.settings.setValue("viewExportCompletedDialog", self.viewExportCompletedDialog)
 
+    def show_export_timings(self, checked):
+        self.showExportTimings = checked
+        self.settings.setValue("showExportTimings", self.showExportTimings)
+
+    def set_disk_cache(self):
+        value, ok = QInputDialog.getInt(self, "プレビューのキャッシュ容量", "一度開いた画像のプレビューを保存しておく容量 (MB)\n0 にするとキャッシュを使わず、保存済みのものも削除します", self.diskCacheMB, 0, 65536, 64)
+        if ok:
+            self.diskCacheMB = value
+            self.settings.setValue("diskCacheMB", value)
+            preview_disk_cache.set_max_bytes(value * 1024 * 1024)
+            self.statusBar.showMessage(f"プレビューのキャッシュ容量を{value}MBに設定しました")
+
+    def set_auto_crop(self, checked):
+        self.autoCrop = checked
+        self.view.auto_crop = checked
+        self.settings.setValue("autoCrop", checked)
+
+    def set_output_profiles(self):
+        text, ok = QInputDialog.getText(self, "出力プロファイルの設定", "比率[@幅x高さ][/pad] をカンマ区切りで指定します\n例: 4:5, 4:5/pad, 1:1@1080x1080, 9:16@1080x1920/pad", QLineEdit.Normal, self.outputProfiles)
+        if not ok:
+            return
+        specs = split_profile_specs(text)
+        try:
+            profiles = [parse_profile(spec) for spec in specs]
+        except ValueError as e:
+            QMessageBox.warning(self, "出力プロファイルの設定", str(e))
+            return
+        if not profiles:
+            specs = DEFAULT_PROFILE_SPECS
+        self.outputProfiles = ", ".join(specs)
+        self.settings.setValue("outputProfiles", self.outputProfiles)
+        self.statusBar.showMessage(f"出力プロファイルを {self.outputProfiles} に設定しました")
+
+    def set_save_manifest(self, checked):
+        self.saveManifest = checked
+        self.settings.setValue("saveManifest", checked)
+
+    def set_encoder_preset(self, action):
+        self.encoderPreset = action.data()
+        self.settings.setValue("encoderPreset", self.encoderPreset)
+        self.statusBar.showMessage(f"出力の画質を{action.text()}に設定しました")
+
+    def set_color_mode(self, action):
+        self.colorMode = action.data()
+        self.settings.setValue("colorMode", self.colorMode)
+        self.statusBar.showMessage(f"ICC プロファイルの扱いを「{action.text()}」に設定しました")
+
+    def set_app_memory(self):
+        value, ok = QInputDialog.getInt(self, "アプリ全体のメモリ上限", "デコードした画像（元画像・プレビュー・出力中の画像など）の合計の上限 (MB)\n超えそうな時はキャッシュを捨て、プレビューを小さくし、出力を1つずつ行います", self.appMemoryMB, 256, 262144, 256)
+        if ok:
+            self.appMemoryMB = value
+            self.settings.setValue("appMemoryMB", value)
+            memory_governor.set_budget(value * 1024 * 1024)
+            self.update_memory_status()
+            self.statusBar.showMessage(f"アプリ全体のメモリ上限を{value}MBに設定しました")
+
+    def set_memory_budget(self):
+        value, ok = QInputDialog.getInt(self, "メモリ予算の設定", "1回の出力で使うメモリの上限 (MB)\nこれを超えそうな大きな画像は帯ごとに分けて処理します", self.memoryBudgetMB, 64, 65536, 64)
+        if ok:
+            self.memoryBudgetMB = value
+            self.settings.setValue("memoryBudgetMB", value)
+            self.statusBar.showMessage(f"メモリ予算を{value}MBに設定しました")
+
 
     def Export(self):
         self.statusBar.showMessage("出力準備中")
-        if self.view.pixmap_item is None or self.view.crop_rect is None:
+        if self.view.image_item is None or self.view.crop_rect is None:
             return
 
-        pixmap = self.view.pixmap_item.pixmap()
-        crop_rect = self.view.crop_rect
+        # 枠の位置はこの時点の値を控えておく（出力中に次の写真へ移ってもよい）
+        crop = self.view.crop_geometry()
         text = self.textContent
         family = self.settings.value("fontFamily", "Arial")
         export_dir = self.settings.value("exportFolder", "")
-        save_path, _ = QFileDialog.getSaveFileName(self, "保存先を選択", export_dir, "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg)")
+        save_path, selected_filter = QFileDialog.getSaveFileName(self, "保存先を選択", export_dir, save_filter_string(), self.exportFilter)
+        if not save_path:
+            self.statusBar.showMessage("出力をキャンセルしました")
+            return
+        save_path = with_default_extension(save_path, selected_filter)
+        self.exportFilter = selected_filter
+        self.settings.setValue("exportFilter", selected_filter)
         comment = self.comment_input.text() if hasattr(self, "comment_input") else ""
         filepath = self.view.current_file
-        self.thread = QThread()
-        self.worker = ExportWorker(pixmap, crop_rect, text, family, save_path, comment, filepath, self.backgroundColor, self.fontColor, self.fontItalic)
-
-        self.worker.moveToThread(self.thread)
-
-        self.thread.started.connect(self.worker.run)
-        self.worker.finished.connect(self.thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.worker.error.connect(self.error_export)
-        self.exportError = False
-
-        self.export.setDisabled(True)
-        self.worker.finished.connect(self.finish_export)
-        self.setEnabled(False)
-        self.statusBar.showMessage("出力中……")
-        self.setWindowTitle(f"出力中…… - {save_path}")
-
-        self.thread.start()
-
-
-    def finish_export(self, save_path):
-        if not self.exportError:
-            self.export.setDisabled(False)
-            self.statusBar.showMessage(f"出力完了 - {save_path}")
-            if self.viewExportCompletedDialog:
+        worker = ExportWorker(crop, text, family, save_path, comment, filepath, self.backgroundColor, self.fontColor, self.fontItalic, self.memoryBudgetMB, self.encoderPreset, self.compositor, self.saveManifest, split_profile_specs(self.outputProfiles), self.colorMode)
+        self.exportQueue.submit(worker)
+        self.show_queue_status()
+
+    def show_queue_status(self):
+        c = self.exportQueue.counts()
+        self.statusBar.showMessage(f"出力中…… (待機 {c[ExportQueue.PENDING]} / 実行中 {c[ExportQueue.RUNNING]} / 書き込み待ち {c[ExportQueue.WRITING]})")
+
+    def finish_export(self, job_id):
+        job = self.exportQueue.jobs[job_id]
+        save_path = job["save_path"]
+        if job["error"] is None:
+            message = f"出力完了 - {save_path}"
+            if self.showExportTimings and job["timings"]:
+                message += f"  [{format_timings(job['timings'])}]"
+            self.statusBar.showMessage(message)
+            if self.viewExportCompletedDialog and not self.closeRequested:
                 QMessageBox.information(self, "出力完了", f"保存が完了しました\n- {save_path}")
         else:
-            self.statusBar.showMessage(f"エラーが発生しました({self.errorDetail})")
-        self.setEnabled(True)
-        self.setWindowTitle(self.currentWindowTitle)
+            self.statusBar.showMessage(f"エラーが発生しました({job['error']}) - {save_path}")
+
+    def update_write_status(self, job_id):
+        # 出力先にまだ書き込んでいない分を常に表示しておく
+        files, pending = output_writer.status()
+        writing = self.exportQueue.counts()[ExportQueue.WRITING]
+        self.writeStatus.setText(f"書き込み待ち {writing}件 ({pending / 1024 / 1024:.1f}MB)" if writing or files else "")
+
+    MEMORY_CATEGORIES = {"source": "元画像", "preview": "プレビュー", "display": "表示", "export": "出力の合成", "write": "書き込み待ち", "overlay": "枠と文字のレイヤー"}
+
+    def update_memory_status(self):
+        snapshot = memory_governor.snapshot()
+        self.memoryStatus.setText(format_memory(snapshot))
+        lines = [f"{self.MEMORY_CATEGORIES.get(k, k)}: {v / 1024 / 1024:.1f}MB" for k, v in snapshot["usage"].items()]
+        hits, misses = overlay_cache.counts()
+        if hits + misses:
+            lines.append(f"枠と文字のキャッシュ: ヒット率 {hit_rate(hits, misses):.0%} ({hits} / {hits + misses})")
+        self.memoryStatus.setToolTip("\n".join(lines))
+
+    def export_queue_idle(self):
+        if self.closeRequested:
+            QApplication.quit()
+
+    def closeEvent(self, event):
+        self.save_current_crop()
+        # 出力中のジョブがあれば、終わるまでウィンドウを隠して待つ
+        if not self.exportQueue.is_idle():
+            self.closeRequested = True
+            QApplication.setQuitOnLastWindowClosed(False)
+            self.hide()
+            event.ignore()
+            return
+        super().closeEvent(event)
 
-    def error_export(self, detail):
-        self.exportError = True
-        self.errorDetail = detail
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.painted:
+            self.painted = True
+            self.firstPainted.emit()
 
     def No_file(self):
         self.export.setDisabled(True)
 
 if __name__ == "__main__":
+    if "--multiprocessing-fork" in sys.argv:
+        # Nuitka等でexe化した場合のワーカープロセス用（freeze_support はこの引数がある時だけ動く）
+        import multiprocessing
+        multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(run_batch(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "watch":
+        sys.exit(run_watch(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "rerender":
+        sys.exit(run_rerender(sys.argv[2:]))
+
+    # --profile: 起動から終了までを cProfile で計測する（メインスレッドのみ）
+    profiler = None
+    if "--profile" in sys.argv:
+        sys.argv.remove("--profile")
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # --startup-time: 最初の描画（と指定画像の表示）までの時間を表示して終了する
+    startup_time = "--startup-time" in sys.argv
+    if startup_time:
+        sys.argv.remove("--startup-time")
+
     app = QApplication(sys.argv)    # PySide6の実行
     app.setWindowIcon(QIcon("icon.ico"))
     window = None
@@ -611,5 +4294,23 @@ if __name__ == "__main__":
     else:
         window = MainWindow()
 
+    if startup_time:
+        def report_startup(label):
+            print(f"{label}: {(time.perf_counter() - _START) * 1000:.0f} ms")
+        window.firstPainted.connect(lambda: report_startup("first paint"))
+        if len(sys.argv) > 1:
+            window.view.imageLoaded.connect(lambda path: (report_startup("first image"), app.quit()))
+            window.view.loadFailed.connect(lambda path, detail: app.quit())
+        else:
+            window.firstPainted.connect(app.quit)
+
     window.show()                   # PySide6のウィンドウを表示
-    sys.exit(app.exec())            # PySide6の終了
\ No newline at end of file
+    code = app.exec()
+
+    if profiler is not None:
+        profiler.disable()
+        stats_path = os.path.join(app_data_dir(), "aspectChange.prof")
+        profiler.dump_stats(stats_path)
+        print("プロファイル結果を保存しました:", stats_path)
+
+    sys.exit(code)                  # PySide6の終了
\ No newline at end of file
@@ -0,0 +1,427 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import tracemalloc
+import statistics
+import subprocess
+
+# 画面を使わずに実行する
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide6.QtCore import *
+from PySide6.QtWidgets import *
+from PySide6.QtGui import *
+from PIL import Image
+import PIL
+import PySide6
+
+import aspectChange as ac
+
+
+DEFAULT_SIZES = "2,12,24,50,100"
+STARTUP_TARGET_MS = 500         # Nuitka ビルドで最初の描画までの目標
+DEFAULT_FORMATS = "jpg,png"
+ExifIFD = 0x8769
+
+
+# ---- メモリ計測 ----
+
+def current_rss():
+    # 現在の RSS (バイト)。取得できない環境では None
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RssSampler:
+    # 計測中の RSS のピークを別スレッドで記録する
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = None
+        self.running = False
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.running = self.peak is not None
+        if self.running:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        tracemalloc.start()
+        return self
+
+    def sample(self):
+        while self.running:
+            rss = current_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+            time.sleep(self.interval)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if self.running:
+            self.running = False
+            self.thread.join()
+            self.peak = max(self.peak, current_rss() or 0)
+
+
+# ---- 入力画像の生成 ----
+
+def make_input(workdir, megapixels, fmt, with_exif):
+    # 3:2 の合成画像（ノイズを拡大したもの）を作る
+    w = int((megapixels * 1_000_000 * 3 / 2) ** 0.5)
+    h = int(w * 2 / 3)
+    name = f"input_{megapixels}mp_{'exif' if with_exif else 'noexif'}.{fmt}"
+    path = os.path.join(workdir, name)
+    if os.path.exists(path):
+        return path
+
+    bands = [Image.effect_noise((max(1, w // 16), max(1, h // 16)), 60 + 20 * i) for i in range(3)]
+    img = Image.merge("RGB", bands).resize((w, h), Image.BILINEAR)
+
+    params = {}
+    if with_exif:
+        exif = Image.Exif()
+        exif[0x010F] = "aspectChange benchmark"                      # Make
+        exif[ExifIFD] = {0x9003: "2024:05:01 12:34:56"}              # DateTimeOriginal
+        params["exif"] = exif
+    if fmt == "jpg":
+        params["quality"] = 90
+    img.save(path, **params)
+    return path
+
+
+# ---- 各処理の計測 ----
+
+def wait_for(*signals, timeout_ms=600000):
+    # どれかのシグナルが来るまで待つ（失敗のシグナルも渡して、タイムアウトまで待ち続けないようにする）
+    loop = QEventLoop()
+    for signal in signals:
+        signal.connect(loop.quit)
+    QTimer.singleShot(timeout_ms, loop.quit)
+    loop.exec()
+
+
+def bench_load(path):
+    view = ac.CropView()
+    view.resize(1280, 800)
+    view.show()
+    start = time.perf_counter()
+    view.load_image(path)
+    errors = []
+    view.loadFailed.connect(lambda filename, detail: errors.append(detail))
+    wait_for(view.imageLoaded, view.loadFailed)
+    elapsed = time.perf_counter() - start
+    if errors or view.current_file != path:
+        raise RuntimeError("プレビューの読み込みに失敗しました" + (f": {errors[0]}" if errors else ""))
+    return elapsed, view
+
+
+def mouse_event(kind, pos, buttons):
+    point = QPointF(pos)
+    return QMouseEvent(kind, point, point, Qt.LeftButton, buttons, Qt.NoModifier)
+
+
+FRAME_BUDGET_MS = 1000 / 60
+
+
+def flush_paint():
+    # update() で溜まった再描画をその場で実行する（ビューが指定した範囲だけが描かれる）
+    QCoreApplication.sendPostedEvents(None, QEvent.UpdateRequest)
+
+
+def frame_stats(times):
+    # 1フレーム（イベント処理 + 再描画）の時間が 60fps の予算に収まった割合
+    over = sum(1 for t in times if t * 1000 > FRAME_BUDGET_MS)
+    return {"max_ms": max(times) * 1000, "frames_over_budget": over, "fps_ok": over == 0}
+
+
+def bench_drag(view, moves):
+    # 枠を左右に往復させる
+    start_pos = view.mapFromScene(view.crop_rect.sceneBoundingRect().center())
+    view.mousePressEvent(mouse_event(QEvent.MouseButtonPress, start_pos, Qt.LeftButton))
+    times = []
+    for i in range(moves):
+        dx = 3 if (i // 50) % 2 == 0 else -3
+        pos = QPoint(start_pos.x() + dx * (i % 50), start_pos.y() + dx * (i % 50))
+        t = time.perf_counter()
+        view.mouseMoveEvent(mouse_event(QEvent.MouseMove, pos, Qt.LeftButton))
+        flush_paint()
+        times.append(time.perf_counter() - t)
+    view.mouseReleaseEvent(mouse_event(QEvent.MouseButtonRelease, start_pos, Qt.NoButton))
+    return times
+
+
+def bench_resize(view, steps):
+    times = []
+    for i in range(steps):
+        delta = -20 if (i // 20) % 2 == 0 else 20
+        t = time.perf_counter()
+        view.resize_crop_rect(delta)
+        flush_paint()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def bench_export(path, view, outdir, memory_budget, compositor):
+    ext = os.path.splitext(path)[1]
+    save_path = os.path.join(outdir, "export" + ext)
+    worker = ac.ExportWorker(view.crop_geometry(), "%year%.%month%.%day% %comment%", "Arial", save_path, "benchmark", path,
+                             QColor(244, 235, 255), QColor(0, 0, 10), False, memory_budget, ac.DEFAULT_PRESET, compositor, False)
+    errors = []
+    worker.error.connect(errors.append)
+    start = time.perf_counter()
+    worker.run()
+    ac.wait_written(worker.writes)
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise RuntimeError(errors[0])
+    for out in (save_path, ac.padded_path_for(save_path)):
+        if not os.path.exists(out):
+            raise RuntimeError(f"出力がありません: {out}")
+    return elapsed
+
+
+def run_export(path, crop, save_path, profiles, compositor):
+    options = {"text": "%year%.%month%.%day% %comment%", "family": "Arial", "backgroundColor": QColor(244, 235, 255), "fontColor": QColor(0, 0, 10),
+               "fontItalic": False, "compositor": compositor, "profiles": profiles}
+    start = time.perf_counter()
+    outputs = ac.export_file(path, crop, save_path, "benchmark", options)
+    ac.wait_written(ac.output_writer.take(outputs))
+    return time.perf_counter() - start
+
+
+def bench_profiles(path, view, outdir, profiles, repeat, compositor):
+    # 複数のプロファイルを1回の出力でまとめて作る場合と、プロファイルごとに別々に出力する場合を比べる
+    crop = view.crop_geometry()
+    save_path = os.path.join(outdir, "profiles" + os.path.splitext(path)[1])
+    together = [run_export(path, crop, save_path, profiles, compositor) for _ in range(repeat)]
+    separate = [sum(run_export(path, crop, save_path, [spec], compositor) for spec in profiles) for _ in range(repeat)]
+    return {"profiles": profiles, "together": summarize(together), "separate": summarize(separate)}
+
+
+def bench_encode(path, view, outdir, formats, presets, repeat):
+    # 合成済みの画像を1回だけ作り、出力形式 × プリセットごとのエンコード時間とファイルサイズを測る
+    image = ac.load_full_image(path)
+    canvas = ac.render_cropped(image, view.crop_geometry(), "2026.01.01 benchmark", "Arial", QColor(244, 235, 255), QColor(0, 0, 10), False)
+    del image
+    exif = ac.output_exif(path)
+    results = {}
+    for fmt in formats:
+        save_path = os.path.join(outdir, "encode." + fmt)
+        for preset in presets:
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                ac.save_image(canvas, save_path, exif, preset).result()
+                times.append(time.perf_counter() - start)
+            results[f"{fmt}-{preset}"] = dict(summarize(times), bytes=os.path.getsize(save_path))
+    return results
+
+
+def summarize(times):
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "p95_ms": sorted(times)[max(0, int(len(times) * 0.95) - 1)] * 1000,
+        "min_ms": min(times) * 1000,
+        "n": len(times),
+    }
+
+
+def run_case(path, megapixels, fmt, with_exif, args, outdir):
+    case = {"megapixels": megapixels, "format": fmt, "exif": with_exif, "file_bytes": os.path.getsize(path)}
+
+    load_times = []
+    with RssSampler() as mem:
+        for _ in range(args.repeat):
+            elapsed, view = bench_load(path)
+            load_times.append(elapsed)
+    case["load"] = dict(summarize(load_times), peak_rss=mem.peak, traced_peak=mem.traced_peak)
+
+    drag_times = bench_drag(view, args.moves)
+    case["drag"] = dict(summarize(drag_times), **frame_stats(drag_times))
+    resize_times = bench_resize(view, args.moves // 5)
+    case["resize"] = dict(summarize(resize_times), **frame_stats(resize_times))
+
+    export_times = []
+    ac.memory_governor.reset_peak()
+    with RssSampler() as mem:
+        for _ in range(args.repeat):
+            export_times.append(bench_export(path, view, outdir, args.memory_budget, args.compositor))
+    # governor_peak はアプリが数えている画像バッファの最大（RSS との差が数えていない分）
+    case["export"] = dict(summarize(export_times), peak_rss=mem.peak, traced_peak=mem.traced_peak, governor_peak=ac.memory_governor.snapshot()["peak"])
+
+    if args.profiles:
+        case["profiles"] = bench_profiles(path, view, outdir, args.profiles.split(","), args.repeat, args.compositor)
+
+    if args.encode_formats:
+        case["encode"] = bench_encode(path, view, outdir, args.encode_formats.split(","), args.presets.split(","), args.repeat)
+
+    view.close()
+    view.deleteLater()
+    return case
+
+
+# ---- 起動時間 ----
+
+def bench_startup(command, image, runs):
+    # 別プロセスで --startup-time 付きで起動し、最初の描画・画像表示までの時間を読み取る
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen"))
+    first_paint = []
+    first_image = []
+    for _ in range(runs):
+        out = subprocess.run(command + ["--startup-time", image], env=env, capture_output=True, text=True, timeout=120).stdout
+        for line in out.splitlines():
+            label, _, value = line.partition(":")
+            if label == "first paint":
+                first_paint.append(float(value.split()[0]))
+            elif label == "first image":
+                first_image.append(float(value.split()[0]))
+    if not first_paint:
+        raise RuntimeError("起動時間を取得できませんでした")
+    return {
+        "first_paint_ms": statistics.median(first_paint),
+        "first_image_ms": statistics.median(first_image) if first_image else None,
+        "runs": runs,
+    }
+
+
+# ---- 前回結果との比較 ----
+
+def case_key(case):
+    return f"{case['megapixels']}mp-{case['format']}-{'exif' if case['exif'] else 'noexif'}"
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {case_key(c): c for c in json.load(f)["results"]}
+
+    regressions = []
+    for case in results:
+        old = baseline.get(case_key(case))
+        if old is None:
+            continue
+        for stage in ("load", "drag", "resize", "export"):
+            before = old[stage]["median_ms"]
+            after = case[stage]["median_ms"]
+            if before > 0 and after > before * (1 + threshold):
+                regressions.append(f"{case_key(case)} {stage}: {before:.1f}ms -> {after:.1f}ms")
+        for name, result in case.get("encode", {}).items():
+            before = old.get("encode", {}).get(name)
+            if before is None:
+                continue
+            if before["median_ms"] > 0 and result["median_ms"] > before["median_ms"] * (1 + threshold):
+                regressions.append(f"{case_key(case)} encode {name}: {before['median_ms']:.1f}ms -> {result['median_ms']:.1f}ms")
+            if result["bytes"] > before["bytes"] * (1 + threshold):
+                regressions.append(f"{case_key(case)} encode {name}: {before['bytes']} bytes -> {result['bytes']} bytes")
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="aspectChange の読み込み・プレビュー・枠操作・出力の処理時間を計測します")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="入力画像の画素数 (MP、カンマ区切り)")
+    parser.add_argument("--formats", default=DEFAULT_FORMATS, help="入力画像の形式 (jpg,png)")
+    parser.add_argument("--exif", choices=("both", "yes", "no"), default="both", help="EXIF あり/なし")
+    parser.add_argument("--repeat", type=int, default=3, help="読み込み・出力の繰り返し回数")
+    parser.add_argument("--moves", type=int, default=200, help="ドラッグ操作のイベント数")
+    parser.add_argument("--memory-budget", type=int, default=ac.DEFAULT_MEMORY_BUDGET_MB, help="出力時のメモリ予算 (MB)")
+    parser.add_argument("--compositor", choices=ac.COMPOSITORS, default=ac.default_compositor(), help="出力時の合成処理")
+    parser.add_argument("--profiles", default="4:5@1080x1350,1:1@1080x1080/pad,9:16", help="まとめて出力する場合と別々に出力する場合を比べる出力プロファイル（空にすると計測しない）")
+    parser.add_argument("--encode-formats", default="jpg,png,webp,avif", help="プリセットごとのエンコードを計測する出力形式（空にすると計測しない）")
+    parser.add_argument("--presets", default=",".join(ac.ENCODER_PRESETS), help="計測するエンコーダーのプリセット")
+    parser.add_argument("--workdir", default=None, help="入力画像の置き場所（省略時は一時フォルダ。指定すると次回再利用する）")
+    parser.add_argument("--output", default="bench_results.json", help="結果の JSON ファイル")
+    parser.add_argument("--baseline", default=None, help="比較する前回の結果 JSON")
+    parser.add_argument("--threshold", type=float, default=0.10, help="この割合以上遅くなったら回帰とみなす")
+    parser.add_argument("--startup-exe", default=None, help="起動時間を計測する実行ファイル（Nuitka でビルドした exe など。省略時は python aspectChange.py）")
+    parser.add_argument("--startup-runs", type=int, default=5, help="起動時間の計測回数（0 で計測しない）")
+    parser.add_argument("--startup-target", type=float, default=STARTUP_TARGET_MS, help="最初の描画までの目標 (ms)")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication([])
+    # 出力は毎回デコードから測るので、デコード済みの元画像は残さない
+    ac.source_registry.set_max_bytes(0)
+    # 読み込みも毎回デコードから測る（プレビューのディスクキャッシュを使わず、ユーザーのキャッシュにも書かない）
+    # （set_max_bytes(0) はキャッシュを消してしまうので、使わないキャッシュに差し替える）
+    ac.preview_disk_cache = ac.DiskPreviewCache(0)
+
+    sizes = [float(s) if "." in s else int(s) for s in args.sizes.split(",")]
+    formats = args.formats.split(",")
+    exif_modes = {"both": (True, False), "yes": (True,), "no": (False,)}[args.exif]
+
+    tmp = None
+    workdir = args.workdir
+    if workdir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="aspectChange-bench-")
+        workdir = tmp.name
+    os.makedirs(workdir, exist_ok=True)
+    outdir = os.path.join(workdir, "out")
+    os.makedirs(outdir, exist_ok=True)
+
+    startup = None
+    if args.startup_runs > 0:
+        command = [args.startup_exe] if args.startup_exe else [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "aspectChange.py")]
+        startup = bench_startup(command, make_input(workdir, sizes[0], "jpg", True), args.startup_runs)
+        startup["command"] = command
+        startup["target_ms"] = args.startup_target
+        startup["ok"] = startup["first_paint_ms"] <= args.startup_target
+        print(f"{'startup':>22}  first paint {startup['first_paint_ms']:6.0f}ms  first image {startup['first_image_ms'] or 0:6.0f}ms  "
+              f"(目標 {args.startup_target:.0f}ms: {'OK' if startup['ok'] else 'NG'})")
+
+    results = []
+    for megapixels in sizes:
+        for fmt in formats:
+            for with_exif in exif_modes:
+                path = make_input(workdir, megapixels, fmt, with_exif)
+                case = run_case(path, megapixels, fmt, with_exif, args, outdir)
+                results.append(case)
+                print(f"{case_key(case):>22}  load {case['load']['median_ms']:8.1f}ms  "
+                      f"drag {case['drag']['median_ms']:6.2f}ms (p95 {case['drag']['p95_ms']:5.2f}ms, 60fps {'OK' if case['drag']['fps_ok'] else 'NG'})  resize {case['resize']['median_ms']:6.2f}ms  "
+                      f"export {case['export']['median_ms']:9.1f}ms  "
+                      f"export RSS {(case['export']['peak_rss'] or 0) / 1024 / 1024:7.1f}MB")
+                if "profiles" in case:
+                    p = case["profiles"]
+                    print(f"{'profiles x' + str(len(p['profiles'])):>22}  together {p['together']['median_ms']:9.1f}ms  separate {p['separate']['median_ms']:9.1f}ms")
+                for name, result in case.get("encode", {}).items():
+                    print(f"{'encode ' + name:>22}  {result['median_ms']:9.1f}ms  {result['bytes'] / 1024:9.1f}KB")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pyside6": PySide6.__version__,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {"repeat": args.repeat, "moves": args.moves, "memory_budget_mb": args.memory_budget, "compositor": args.compositor},
+        "startup": startup,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"結果を {args.output} に保存しました")
+
+    if tmp is not None:
+        tmp.cleanup()
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        for line in regressions:
+            print("回帰:", line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))